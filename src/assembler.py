@@ -4,82 +4,132 @@
 import re
 import pathlib
 import json
-# TODO: make this a cli tool, clean up the code, add debugger by adding another file that maps rom to labels & line numbers
-
-asm_map = {
+import hashlib
+import functools
+import argparse
+import sys
+import time
+# TODO: clean up the code
+
+# bump whenever the output for the same source changes, to invalidate build caches
+ASSEMBLER_VERSION = 4
+
+# mnemonic -> addressing mode -> opcode and operand bytes
+# addressing modes: "inherent" (no operand), "immediate" (#value), "direct" (value),
+# "x" and "y" (value,x / value,y)
+asm_table = {
     # Data Movement Instructions
-    r"^tab$": [0x00],
-    r"^tba$": [0x01],
-    r"^ldaa\s+#((?:\$|%)?[a-z0-9_]+)$": [0x02, "mm"],
-    r"^ldab\s+#((?:\$|%)?[a-z0-9_]+)$": [0x03, "mm"],
-    r"^ldaa\s+((?:\$|%)?[a-z0-9_]+)$": [0x04, "ll", "hh"],
-    r"^ldab\s+((?:\$|%)?[a-z0-9_]+)$": [0x05, "ll", "hh"],
-    r"^staa\s+((?:\$|%)?[a-z0-9_]+)$": [0x06, "ll", "hh"],
-    r"^stab\s+((?:\$|%)?[a-z0-9_]+)$": [0x07, "ll", "hh"],
-    r"^ldx\s+#((?:\$|%)?[a-z0-9_]+)$": [0x08, "ii", "jj"],
-    r"^ldy\s+#((?:\$|%)?[a-z0-9_]+)$": [0x09, "ii", "jj"],
-    r"^ldx\s+((?:\$|%)?[a-z0-9_]+)$": [0x0A, "ll", "hh"],
-    r"^ldy\s+((?:\$|%)?[a-z0-9_]+)$": [0x0B, "ll", "hh"],
-
-    # regular data movement instructions
-    r"^ldaa\s+((?:\$|%)?[a-z0-9_]+),x$": [0x0C, "dd"],
-    r"^ldaa\s+((?:\$|%)?[a-z0-9_]+),y$": [0x0D, "dd"],
-    r"^ldab\s+((?:\$|%)?[a-z0-9_]+),x$": [0x0E, "dd"],
-    r"^ldab\s+((?:\$|%)?[a-z0-9_]+),y$": [0x0F, "dd"],
-    r"^staa\s+((?:\$|%)?[a-z0-9_]+),x$": [0x10, "dd"],
-    r"^staa\s+((?:\$|%)?[a-z0-9_]+),y$": [0x11, "dd"],
-    r"^stab\s+((?:\$|%)?[a-z0-9_]+),x$": [0x12, "dd"],
-    r"^stab\s+((?:\$|%)?[a-z0-9_]+),y$": [0x13, "dd"],
+    "tab": {"inherent": [0x00]},
+    "tba": {"inherent": [0x01]},
+    "ldaa": {
+        "immediate": [0x02, "mm"],
+        "direct": [0x04, "ll", "hh"],
+        "x": [0x0C, "dd"],
+        "y": [0x0D, "dd"],
+    },
+    "ldab": {
+        "immediate": [0x03, "mm"],
+        "direct": [0x05, "ll", "hh"],
+        "x": [0x0E, "dd"],
+        "y": [0x0F, "dd"],
+    },
+    "staa": {
+        "direct": [0x06, "ll", "hh"],
+        "x": [0x10, "dd"],
+        "y": [0x11, "dd"],
+    },
+    "stab": {
+        "direct": [0x07, "ll", "hh"],
+        "x": [0x12, "dd"],
+        "y": [0x13, "dd"],
+    },
+    "ldx": {"immediate": [0x08, "ii", "jj"], "direct": [0x0A, "ll", "hh"]},
+    "ldy": {"immediate": [0x09, "ii", "jj"], "direct": [0x0B, "ll", "hh"]},
 
     # ALU Related Instructions
-    r"^sum_ba$": [0x14],
-    r"^sum_ab$": [0x15],
-    r"^and_ba$": [0x16],
-    r"^and_ab$": [0x17],
-    r"^or_ba$": [0x18],
-    r"^or_ab$": [0x19],
-    r"^coma$": [0x1A],
-    r"^comb$": [0x1B],
-    r"^shfa_l$": [0x1C],
-    r"^shfa_r$": [0x1D],
-    r"^shfb_l$": [0x1E],
-    r"^shfb_r$": [0x1F],
-    r"^inx$": [0x30],
-    r"^iny$": [0x31],
+    "sum_ba": {"inherent": [0x14]},
+    "sum_ab": {"inherent": [0x15]},
+    "and_ba": {"inherent": [0x16]},
+    "and_ab": {"inherent": [0x17]},
+    "or_ba": {"inherent": [0x18]},
+    "or_ab": {"inherent": [0x19]},
+    "coma": {"inherent": [0x1A]},
+    "comb": {"inherent": [0x1B]},
+    "shfa_l": {"inherent": [0x1C]},
+    "shfa_r": {"inherent": [0x1D]},
+    "shfb_l": {"inherent": [0x1E]},
+    "shfb_r": {"inherent": [0x1F]},
+    "inx": {"inherent": [0x30]},
+    "iny": {"inherent": [0x31]},
     # Branch Instructions
-    r"^beq\s+((?:\$|%)?[a-zA-Z0-9_]+)$": [0x20, "bb"],
-    r"^bne\s+((?:\$|%)?[a-zA-Z0-9_]+)$": [0x21, "bb"],
-    r"^bn\s+((?:\$|%)?[a-zA-Z0-9_]+)$": [0x22, "bb"],
-    r"^bp\s+((?:\$|%)?[a-zA-Z0-9_]+)$": [0x23, "bb"],
+    "beq": {"direct": [0x20, "bb"]},
+    "bne": {"direct": [0x21, "bb"]},
+    "bn": {"direct": [0x22, "bb"]},
+    "bp": {"direct": [0x23, "bb"]},
     # 16-bit branch instructions... 8 bits doesnt cut it
-    r"^beq16\s+((?:\$|%)?[a-zA-Z0-9_]+)$": [0x24, "ll", "hh"],
-    r"^bne16\s+((?:\$|%)?[a-zA-Z0-9_]+)$": [0x25, "ll", "hh"],
-    r"^bn16\s+((?:\$|%)?[a-zA-Z0-9_]+)$": [0x26, "ll", "hh"],
-    r"^bp16\s+((?:\$|%)?[a-zA-Z0-9_]+)$": [0x27, "ll", "hh"],
+    "beq16": {"direct": [0x24, "ll", "hh"]},
+    "bne16": {"direct": [0x25, "ll", "hh"]},
+    "bn16": {"direct": [0x26, "ll", "hh"]},
+    "bp16": {"direct": [0x27, "ll", "hh"]},
+}
+
+# the two forms of each branch, for branch relaxation
+short_branches = {"beq16": "beq", "bne16": "bne", "bn16": "bn", "bp16": "bp"}
+long_branches = {short: long for long, short in short_branches.items()}
+
+# estimated cycles for each opcode: one per byte fetched, one per byte of memory read or
+# written, and one to execute
+cycle_costs = {}
+for modes in asm_table.values():
+    for mode, opcode in modes.items():
+        cycle_costs[opcode[0]] = len(opcode) + 1
+for opcode in (0x04, 0x05, 0x06, 0x07, 0x0C, 0x0D, 0x0E, 0x0F, 0x10, 0x11, 0x12, 0x13):
+    cycle_costs[opcode] += 1
+for opcode in (0x0A, 0x0B):
+    cycle_costs[opcode] += 2
+
+# registers written by each mnemonic, for the peephole optimizer
+register_writes = {
+    "tab": "b", "tba": "a", "ldaa": "a", "ldab": "b", "ldx": "x", "ldy": "y",
+    "sum_ba": "a", "sum_ab": "b", "and_ba": "a", "and_ab": "b", "or_ba": "a", "or_ab": "b",
+    "coma": "a", "comb": "b", "shfa_l": "a", "shfa_r": "a", "shfb_l": "b", "shfb_r": "b",
+    "inx": "x", "iny": "y",
 }
 
-# Assembler directives:
+# Assembler directives and the arguments they take:
 # org <address> - Set the origin for the program
 # <label>: equ <value> - Define a macro
 # dc.b <value> - Define a constant byte
 # ds.b <size> - Define a block of memory
-asm_directives = [
-    r"^(org)\s+((?:\$|%)?[a-f0-9]+)$",
-    r"^(equ)\s+((?:\$|%)?[a-f0-9]+)$",
-    r"^(db)\s+((?:\$|%)?[a-f0-9]+)$",
-    r"^(dc.b)\s+([\$%a-f0-9,\s]+)$",
-    r"^(ds.b)\s+((?:\$|%)?[a-f0-9]+)$",
-]
+asm_directives = {
+    "org": re.compile(r"^(?:\$|%)?[a-f0-9]+$"),
+    "equ": re.compile(r"^(?:\$|%)?[a-f0-9]+$"),
+    "db": re.compile(r"^(?:\$|%)?[a-f0-9]+$"),
+    "dc.b": re.compile(r"^[\$%a-f0-9,\s]+$"),
+    "ds.b": re.compile(r"^(?:\$|%)?[a-f0-9]+$"),
+}
+
+# optional label, mnemonic, and everything after it
+line_format = re.compile(r"^(?:([a-z0-9_]+):)?\s*(\S*)\s*(.*)$")
+operand_format = re.compile(r"^(#)?((?:\$|%)?[a-z0-9_]+)(?:,([xy]))?$")
+comment_format = re.compile(r";.*|@.*")
+
+# how the operand is written for each addressing mode, for listings
+operand_formats = {"inherent": "", "immediate": "#{}", "direct": "{}", "x": "{},x", "y": "{},y"}
 
 def read_asm(filename: str) -> list[str]:
     with open(filename, 'r') as f:
-        lines = f.readlines()
-    
+        return asm_lines(f.read())
+
+def asm_lines(source: str) -> list[str]:
+    # the lines of source that process_asm works on
+    lines = source.splitlines()
+
     # remove spaces from beginning and end, as well as newlines
     lines = [line.strip() for line in lines]
 
     # remove comments
-    lines = [re.sub(r';.*|@.*', '', line).strip() for line in lines]
+    lines = [comment_format.sub('', line).strip() for line in lines]
     
     # pack lines
     lines = [(line, (i+1, line)) for i, line in enumerate(lines)]
@@ -108,126 +158,218 @@ def parse_number(num: str) -> int:
     
     return int(num)
 
+@functools.lru_cache(maxsize=65536)
+def parse_line(line: str) -> tuple[str | None, str, str | None, str]:
+    # splits a line into its label, mnemonic, addressing mode and argument. Directives
+    # have no addressing mode, and their argument is everything after the mnemonic.
+    # Lines only depend on their own text, so reassembling an edited file only parses
+    # the lines that changed
+    label, mnemonic, operand = line_format.match(line).groups()
+
+    if mnemonic in asm_directives:
+        if asm_directives[mnemonic].match(operand):
+            return label, mnemonic, None, operand
+    elif mnemonic in asm_table:
+        if not operand:
+            mode, argument = "inherent", None
+        else:
+            matches = operand_format.match(operand)
+            if matches is None:
+                mode = None
+            else:
+                immediate, argument, index = matches.groups()
+                if immediate and index:
+                    mode = None
+                elif immediate:
+                    mode = "immediate"
+                else:
+                    mode = index or "direct"
+
+        if mode in asm_table[mnemonic]:
+            return label, mnemonic, mode, argument
+
+    instruction = line.split(":", 1)[1].strip() if label is not None else line
+    raise ValueError(f"Unknown instruction: {instruction}")
+
+def code_labels(statements: list[tuple]) -> set[str]:
+    # labels on instructions, as opposed to ones on directives or equ constants
+    return {statement[0] for statement in statements if statement[0] is not None and statement[2] is not None}
+
+def peephole(statements: list[tuple], stats: dict = None) -> list[tuple]:
+    # drops instructions that provably don't change anything: loads of a value the register
+    # already holds (from an immediate load, or from storing it to the same operand) and a
+    # tab/tba right after a tba/tab. What's known is forgotten at every label, since anything
+    # can branch there, and memory is forgotten at every store, since two operands can name
+    # the same address. Branches to anything but a label could land anywhere, so the
+    # statements are left alone if there are any.
+    # Instructions, bytes and cycles saved are added to stats per routine (the last label)
+    labels = code_labels(statements)
+    for label, mnemonic, mode, argument, original in statements:
+        if (mnemonic in short_branches or mnemonic in long_branches) and argument not in labels:
+            return statements
+
+    known = {}  # register -> (mode, argument) of an operand it's known to be equal to
+    optimized = []
+    routine = None
+    previous = None
+
+    for statement in statements:
+        label, mnemonic, mode, argument, original = statement
+
+        if mode is None:
+            optimized.append(statement)
+            continue
+
+        if label is not None:
+            known.clear()
+            routine = label
+            previous = None
+
+        register = register_writes.get(mnemonic)
+
+        if mnemonic in ("tab", "tba"):
+            redundant = previous in ("tab", "tba")
+        else:
+            redundant = register is not None and known.get(register) == (mode, argument)
+
+        if redundant:
+            if stats is not None:
+                opcode = asm_table[mnemonic][mode]
+                saved = stats.setdefault("peephole", {}).setdefault(routine or "", {"instructions": 0, "bytes": 0, "cycles": 0})
+                saved["instructions"] += 1
+                saved["bytes"] += len(opcode)
+                saved["cycles"] += cycle_costs[opcode[0]]
+            continue
+
+        if register is not None:
+            # forget the old value of the register, and memory indexed by it
+            for other, (other_mode, other_argument) in list(known.items()):
+                if other == register or other_mode == register:
+                    del known[other]
+
+        if mode == "immediate":
+            known[register] = (mode, argument)
+        elif mnemonic in ("staa", "stab"):
+            for other, (other_mode, other_argument) in list(known.items()):
+                if other_mode != "immediate":
+                    del known[other]
+            known.setdefault(mnemonic[-1], (mode, argument))
+        elif mnemonic == "tab" and "a" in known:
+            known["b"] = known["a"]
+        elif mnemonic == "tba" and "b" in known:
+            known["a"] = known["b"]
+
+        optimized.append(statement)
+        previous = mnemonic
+
+    return optimized
+
 def hexify(value: int, digits: int = 4) -> str:
     return hex(value)[2:].zfill(digits).upper()[-digits:]
-    
-def process_asm(lines: list[str]) -> None:
-    memory = {}
-
-    instruction_format = r"^(?:([a-zA-Z0-9_]+):)?\s*(.*)\s*$"
-    
-    macros = {}
-
-    already_checked = {}
-
-    running_address = 0x0000
-    
-    # first pass: assembler directives
-    for line_num, (line, original) in enumerate(lines):
-        label, instruction = re.match(instruction_format, line).groups()
-
-        for format in asm_directives:
-            matches = re.match(format, instruction)
-            if matches:
-                already_checked[line_num] = True
-                pnemonic, argument = matches.groups()
-                
-                match pnemonic:
-                    case "org":
-                        running_address = parse_number(argument)
-                        if label is not None:
-                            macros[label] = running_address
-                        break
-                    case "equ":
-                        macros[label] = argument
-                        break
-                    case "dc.b":
-                        if label is not None:
-                            macros[label] = str(running_address)
-                        
-                        arguments = argument.split(",")
-                        arguments = [arg.strip() for arg in arguments]
-
-                        for i in range(len(arguments)):
-                            num = arguments[i]
-                            if (running_address + i) in memory:
-                                raise ValueError(f"Address ${running_address + i:04X} already defined in memory")
-                            
-                            memory[running_address + i] = parse_number(num)
-
-                        running_address += len(arguments)
-                        break
-                    case "ds.b":
-                        if label is not None:
-                            macros[label] = str(running_address)
-                        size = parse_number(argument)
-
-                        for i in range(size):
-                            if (running_address + i) in memory:
-                                raise ValueError(f"Address ${running_address + i:04X} already defined in memory")
-                            memory[running_address + i] = 0
-                      
-                        running_address += size
-                        break
-                    case _:
-                        continue
-
-                break
-
-    prev_running_address = running_address
-
-    # second pass: labels to addresses
-    for line_num, (line, original) in enumerate(lines):
-        label, instruction = re.match(instruction_format, line).groups()
-        
-        for format in asm_map:
-            match = re.match(format, instruction)
-            if match:
-                opcode = asm_map[format]
 
-                if label is not None:
-                    macros[label] = str(running_address)
-
-                running_address += len(opcode)
-                break
-
-    running_address = prev_running_address
-
-    # third pass: assemble
-    original_lines = {}
-    for line_num, (line, original) in enumerate(lines):
-        label, instruction = re.match(instruction_format, line).groups()
-
-        for format in asm_map:
-            match = re.match(format, instruction)
-            if match:
-                opcode = asm_map[format]
-                operands = list(match.groups())
-
-                for i, operand in enumerate(operands):
-                    if operand in macros:
-                        operands[i] = macros[operand]
-
-                    operands[i] = parse_number(operands[i])
-
-                memory[running_address] = opcode[0]
-
-                if len(opcode) == 2:
-                    memory[running_address + 1] = operands[0]
-                if len(opcode) == 3:
-                    operand_bytes = int.to_bytes(operands[0], byteorder='little', length=2)
-                    memory[running_address + 1] = operand_bytes[0]
-                    memory[running_address + 2] = operand_bytes[1]
-                
-                original_lines[running_address] = original
-
-                running_address += len(opcode)
-                break
+def intel_hex(memory: dict[int, int], record_size: int = 16) -> str:
+    # data records for every run of defined bytes, split at record_size, then end of file
+    runs = []
+    for location in sorted(memory.keys()):
+        if runs and location == runs[-1][-1] + 1:
+            runs[-1].append(location)
         else:
-            if not already_checked.get(line_num, False):
-                raise ValueError(f"Unknown instruction: {instruction}")
-
-    
+            runs.append([location])
+
+    records = ""
+    for run in runs:
+        for i in range(0, len(run), record_size):
+            address = run[i]
+            data = [memory[location] & 0xFF for location in run[i:i + record_size]]
+            record = [len(data), address >> 8, address & 0xFF, 0x00] + data
+            checksum = -sum(record) & 0xFF
+            records += ":" + "".join(hexify(byte, 2) for byte in record) + hexify(checksum, 2) + "\n"
+
+    return records + ":00000001FF\n"
+
+def cheapest_path(body: list[tuple], labels: dict[str, int]) -> int:
+    # fewest cycles from the first instruction of a loop body to the end of its last one
+    # (the branch back), where every branch before that either falls through or, if its
+    # target is further on in the body, jumps there. Branches out of the loop only fall
+    # through, since they end the iteration
+    end = body[-1][0]
+    costs = {body[0][0]: 0}
+
+    for address, encoded, label, mnemonic, mode, argument, original in body:
+        if address not in costs:
+            continue
+
+        cost = costs[address] + cycle_costs[encoded[0]]
+        if address == end:
+            return cost
+
+        following = address + len(encoded)
+        costs[following] = min(costs.get(following, cost), cost)
+
+        target = labels.get(argument)
+        if 0x20 <= encoded[0] <= 0x27 and target is not None and address < target <= end:
+            costs[target] = min(costs.get(target, cost), cost)
+
+    return 0
+
+def listing(instructions: list[tuple]) -> tuple[str, dict]:
+    # size and cycle estimate of every routine (the code from one label to the next) from
+    # the assembled (address, bytes, label, mnemonic, mode, argument, original line)
+    # instructions, as text and as JSON. A branch back to a label in the same routine or
+    # an earlier one marks a loop from that label to the branch. The cost of one iteration
+    # is given as a range: cycles counts every instruction in the loop, which is an upper
+    # bound when forward branches skip some of them, and min_cycles is the cheapest way
+    # through, taking or falling through each forward branch
+    routines = []
+    labels = {instruction[2]: instruction[0] for instruction in instructions if instruction[2] is not None}
+
+    for address, encoded, label, mnemonic, mode, argument, (number, source) in instructions:
+        if label is not None or not routines:
+            routines.append({"label": label, "start": address, "end": address, "bytes": 0, "cycles": 0, "loops": [], "instructions": []})
+
+        routine = routines[-1]
+        routine["end"] = address + len(encoded) - 1
+        routine["bytes"] += len(encoded)
+        routine["cycles"] += cycle_costs[encoded[0]]
+        routine["instructions"].append({
+            "address": address,
+            "bytes": " ".join(hexify(byte, 2) for byte in encoded),
+            "cycles": cycle_costs[encoded[0]],
+            "instruction": f"{mnemonic} {operand_formats[mode].format(argument)}".strip(),
+            "line": number,
+            "source": source,
+        })
+
+        target = labels.get(argument)
+        if 0x20 <= encoded[0] <= 0x27 and target is not None and target <= address:
+            body = [i for i in instructions if target <= i[0] <= address]
+            routine["loops"].append({
+                "label": argument,
+                "start": target,
+                "end": address + len(encoded) - 1,
+                "bytes": sum(len(i[1]) for i in body),
+                "cycles": sum(cycle_costs[i[1][0]] for i in body),
+                "min_cycles": cheapest_path(body, labels),
+            })
+
+    text = ""
+    for routine in routines:
+        text += f"{routine['label'] or '(start)'}: ${hexify(routine['start'])}-${hexify(routine['end'])}, {routine['bytes']} bytes, {routine['cycles']} cycles\n"
+        for loop in routine["loops"]:
+            text += f"  loop {loop['label']}: ${hexify(loop['start'])}-${hexify(loop['end'])}, {loop['bytes']} bytes, {loop['min_cycles']}-{loop['cycles']} cycles per iteration\n"
+        for instruction in routine["instructions"]:
+            text += f"  {hexify(instruction['address'])}  {instruction['bytes']:<8}  {instruction['cycles']:>2}  {instruction['instruction']:<20}  ; line {instruction['line']}\n"
+        text += "\n"
+
+    data = {
+        "routines": routines,
+        "bytes": sum(routine["bytes"] for routine in routines),
+        "cycles": sum(routine["cycles"] for routine in routines),
+    }
+    return text, data
+
+def mif_files(memory: dict[int, int]) -> tuple[str, str]:
+    # contents of rom.mif and ram.mif
     header = """DEPTH = 4096;
 WIDTH = 8;
 ADDRESS_RADIX = HEX;
@@ -275,32 +417,327 @@ BEGIN
                 ram += f"[0000..0FFF] : 00;\n"
             else:
                 ram += f"[{hexify(last_location - 0x1000)}..0FFF] : 00;\n"
+
+    return header + rom + "\nEND;\n", header + ram + "\nEND;\n"
+
+class Image:
+    # an assembled program: the 4 KiB of ROM and 4 KiB of RAM it starts with, the address
+    # of every label, and the source line of every instruction. bytes() of it is the flat
+    # 8 KiB image the simulator can load
+    def __init__(self, memory: dict[int, int], symbols: dict[str, int], lines: dict[int, tuple[int, str]]):
+        self.memory = memory  # address -> byte, for just the addresses the program sets
+
+        image = bytearray(0x2000)
+        for location in memory:
+            if location < 0x2000:
+                image[location] = memory[location] & 0xFF
+
+        self.rom = bytes(image[:0x1000])
+        self.ram = bytes(image[0x1000:])
+        self.symbols = symbols
+        self.lines = lines
+
+    def __bytes__(self) -> bytes:
+        return self.rom + self.ram
+
+def process_asm(lines: list[str], binary: bool = False, hex_file: bool = False, path: pathlib.Path = None, relax: bool = True, optimize: bool = False, listing_file: bool = False, stats: dict = None) -> Image:
+    # relax picks the 8-bit or 16-bit form of every branch depending on whether its target
+    # is in the same page, and optimize runs the peephole pass over the instructions first.
+    # Counts of what was changed are added to stats if it's given. The output files are
+    # only written if there's a path to write them to
+    memory = {}
+
+    # every line is only parsed once, the passes below work on the parsed statements
+    statements = [(*parse_line(line), original) for line, original in lines]
+    
+    macros = {}
+
+    running_address = 0x0000
+    
+    # first pass: assembler directives
+    for label, mnemonic, mode, argument, original in statements:
+        match mnemonic:
+            case "org":
+                running_address = parse_number(argument)
+                if label is not None:
+                    macros[label] = str(running_address)
+            case "equ":
+                macros[label] = argument
+            case "dc.b":
+                if label is not None:
+                    macros[label] = str(running_address)
                 
+                arguments = argument.split(",")
+                arguments = [arg.strip() for arg in arguments]
+
+                for i in range(len(arguments)):
+                    num = arguments[i]
+                    if (running_address + i) in memory:
+                        raise ValueError(f"Address ${running_address + i:04X} already defined in memory")
+                    
+                    memory[running_address + i] = parse_number(num)
+
+                running_address += len(arguments)
+            case "ds.b":
+                if label is not None:
+                    macros[label] = str(running_address)
+                size = parse_number(argument)
+
+                for i in range(size):
+                    if (running_address + i) in memory:
+                        raise ValueError(f"Address ${running_address + i:04X} already defined in memory")
+                    memory[running_address + i] = 0
+              
+                running_address += size
+
+    prev_running_address = running_address
+
+    # removing instructions moves everything after them, so this runs before the layout
+    if optimize:
+        statements = peephole(statements, stats)
+
+    # second pass: labels to addresses. With relax, every branch starts out in its 8-bit
+    # form and is switched to the 16-bit one if its target turns out to be in another
+    # page, which can move other labels, so the layout is redone until nothing changes.
+    # Branches only ever grow, so this always settles. Only branches to code labels are
+    # relaxed: a number or equ constant means a different address in the 8-bit and
+    # 16-bit forms, so those are left as written
+    relaxable = set()
+    if relax:
+        labels = code_labels(statements)
+        relaxable = {i for i, statement in enumerate(statements) if (statement[1] in short_branches or statement[1] in long_branches) and statement[3] in labels}
+
+    lengthened = set()
+
+    while True:
+        running_address = prev_running_address
+        addresses = {}
+
+        for i, (label, mnemonic, mode, argument, original) in enumerate(statements):
+            if mode is None:
+                continue
+
+            if i in relaxable:
+                mnemonic = long_branches.get(mnemonic, mnemonic) if i in lengthened else short_branches.get(mnemonic, mnemonic)
+
+            if label is not None:
+                macros[label] = str(running_address)
+
+            addresses[i] = running_address
+            running_address += len(asm_table[mnemonic][mode])
+
+        too_far = set()
+        for i in relaxable - lengthened:
+            argument = statements[i][3]
+            target = parse_number(macros.get(argument, argument))
+            # 8-bit branches keep the page of the pc, which points at the operand
+            if (addresses[i] + 1) & 0xFF00 != target & 0xFF00:
+                too_far.add(i)
+
+        if not too_far:
+            break
+
+        lengthened |= too_far
+
+    for i in relaxable:
+        label, mnemonic, mode, argument, original = statements[i]
+        relaxed = long_branches.get(mnemonic, mnemonic) if i in lengthened else short_branches.get(mnemonic, mnemonic)
+
+        if stats is not None and relaxed != mnemonic:
+            key = "branches_lengthened" if i in lengthened else "branches_shortened"
+            stats[key] = stats.get(key, 0) + 1
+            stats["bytes_saved"] = stats.get("bytes_saved", 0) + (-1 if i in lengthened else 1)
+
+        statements[i] = (label, relaxed, mode, argument, original)
+
+    running_address = prev_running_address
+
+    # third pass: assemble
+    original_lines = {}
+    instructions = []
+    for label, mnemonic, mode, argument, original in statements:
+        if mode is None:
+            continue
+
+        opcode = asm_table[mnemonic][mode]
 
-    path = pathlib.Path(__file__).parent.joinpath('output')
+        memory[running_address] = opcode[0]
+
+        if argument is not None:
+            operand = parse_number(macros.get(argument, argument))
+
+            if len(opcode) == 2:
+                memory[running_address + 1] = operand
+            if len(opcode) == 3:
+                operand_bytes = int.to_bytes(operand, byteorder='little', length=2)
+                memory[running_address + 1] = operand_bytes[0]
+                memory[running_address + 2] = operand_bytes[1]
+        
+        original_lines[running_address] = original
+        instructions.append((running_address, [memory[running_address + i] for i in range(len(opcode))], label, mnemonic, mode, argument, original))
+
+        running_address += len(opcode)
+
+    symbols = {name: parse_number(macros[name]) for name in macros}
+    image = Image(memory, symbols, original_lines)
+
+    # without a path nothing is written, and the image is all there is
+    if path is None:
+        return image
+
+    path = pathlib.Path(path)
     path.mkdir(parents=True, exist_ok=True)
-    
+
+    rom, ram = mif_files(memory)
+
     with open(path.joinpath('rom.mif'), 'w') as f:
-        f.write(header)
         f.write(rom)
-        f.write("\nEND;\n")
 
     with open(path.joinpath('ram.mif'), 'w') as f:
-        f.write(header)
         f.write(ram)
-        f.write("\nEND;\n")
 
     with open(path.joinpath("symbols.dbg"), 'w') as f:
-        symbols = {name: parse_number(macros[name]) for name in macros}
         json.dump({"symbols": symbols, "lines": original_lines}, f)
 
+    if binary:
+        # flat image of the whole address space, ROM followed by RAM
+        with open(path.joinpath("memory.bin"), 'wb') as f:
+            f.write(bytes(image))
+
+    if hex_file:
+        with open(path.joinpath("memory.hex"), 'w') as f:
+            f.write(intel_hex(memory))
+
+    if listing_file:
+        text, data = listing(instructions)
+        with open(path.joinpath("listing.txt"), 'w') as f:
+            f.write(text)
+        with open(path.joinpath("listing.json"), 'w') as f:
+            json.dump(data, f, indent=2)
+
+    return image
+
 
-def main() -> None:
+def build_hash(source: str, binary: bool, hex_file: bool, relax: bool, optimize: bool, listing_file: bool) -> str:
+    key = f"{ASSEMBLER_VERSION}:{binary}:{hex_file}:{relax}:{optimize}:{listing_file}\n{source}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def assemble_file(filename: str | pathlib.Path, path: pathlib.Path = None, binary: bool = False, hex_file: bool = False, force: bool = False, relax: bool = True, optimize: bool = False, listing_file: bool = False) -> dict:
+    # assembles filename into path unless the outputs there were already built from the
+    # same source with the same options. Returns a summary of the build
+    if path is None:
+        path = pathlib.Path(__file__).parent.joinpath('output')
+    path = pathlib.Path(path)
+
+    with open(filename, 'r') as f:
+        digest = build_hash(f.read(), binary, hex_file, relax, optimize, listing_file)
+
+    outputs = ["rom.mif", "ram.mif", "symbols.dbg"] + ["memory.bin"] * binary + ["memory.hex"] * hex_file + ["listing.txt", "listing.json"] * listing_file
+
+    build_file = path.joinpath("build.json")
+    if not force and build_file.exists() and all(path.joinpath(output).exists() for output in outputs):
+        with open(build_file, 'r') as f:
+            build = json.load(f)
+            if build.get("hash") == digest:
+                return {**build, "assembled": False}
+
+    stats = {"branches_shortened": 0, "branches_lengthened": 0, "bytes_saved": 0}
+    memory = process_asm(read_asm(filename), binary=binary, hex_file=hex_file, path=path, relax=relax, optimize=optimize, listing_file=listing_file, stats=stats).memory
+
+    build = {
+        "source": str(filename),
+        "output": str(path),
+        "hash": digest,
+        "rom_bytes": sum(1 for location in memory if location <= 0x0FFF),
+        "ram_bytes": sum(1 for location in memory if location > 0x0FFF),
+        **stats,
+    }
+
+    with open(build_file, 'w') as f:
+        json.dump(build, f)
+
+    return {**build, "assembled": True}
+
+def build_program(filename: pathlib.Path, path: pathlib.Path, binary: bool, hex_file: bool, force: bool, relax: bool, optimize: bool, listing_file: bool) -> dict:
+    # runs in a worker process, so errors are reported in the summary instead of raised
+    start = time.perf_counter()
+    try:
+        result = assemble_file(filename, path, binary=binary, hex_file=hex_file, force=force, relax=relax, optimize=optimize, listing_file=listing_file)
+    except Exception as e:
+        result = {"source": str(filename), "output": str(path), "error": f"{type(e).__name__}: {e}"}
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+def find_sources(inputs: list[str]) -> list[pathlib.Path]:
+    sources = []
+    for name in inputs:
+        name = pathlib.Path(name)
+        if name.is_dir():
+            sources.extend(sorted(name.glob("*.asm")))
+        else:
+            sources.append(name)
+    return sources
+
+def main(argv: list[str] = None) -> int:
     path = pathlib.Path(__file__).parent
-    filename = path.joinpath("program", "game-of-life.asm")
-    lines = read_asm(filename)
-    process_asm(lines)
+
+    parser = argparse.ArgumentParser(description="Assemble G-CPU programs into MIF files for the simulator.")
+    parser.add_argument("inputs", nargs="*", default=[str(path.joinpath("program", "game-of-life.asm"))], help="assembly files, or directories of them")
+    parser.add_argument("-o", "--output", default=str(path.joinpath("output")), help="output directory. With more than one program, each gets its own subdirectory named after it")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("--no-binary", dest="binary", action="store_false", help="don't write memory.bin")
+    parser.add_argument("--no-hex", dest="hex_file", action="store_false", help="don't write memory.hex")
+    parser.add_argument("--no-relax", dest="relax", action="store_false", help="keep every branch in the form it was written in")
+    parser.add_argument("-O", "--optimize", action="store_true", help="remove redundant loads and register transfers")
+    parser.add_argument("-l", "--listing", dest="listing_file", action="store_true", help="write listing.txt and listing.json with the size and estimated cycles of every routine")
+    parser.add_argument("-f", "--force", action="store_true", help="assemble even if the outputs are up to date")
+    parser.add_argument("--summary", help="write the JSON summary here instead of stdout")
+    args = parser.parse_args(argv)
+
+    sources = find_sources(args.inputs)
+    output = pathlib.Path(args.output)
+
+    if len(sources) == 1 and not pathlib.Path(args.inputs[0]).is_dir():
+        paths = [output]
+    else:
+        paths = [output.joinpath(source.stem) for source in sources]
+
+    # programs built into the same directory in parallel would overwrite each other
+    names = {}
+    for source, program_path in zip(sources, paths):
+        names.setdefault(program_path, []).append(str(source))
+    clashes = [", ".join(clashing) for clashing in names.values() if len(clashing) > 1]
+    if clashes:
+        parser.error(f"programs with the same name would be built into the same directory: {'; '.join(clashes)}")
+
+    start = time.perf_counter()
+
+    if len(sources) == 1:
+        # not worth starting a pool for
+        results = [build_program(sources[0], paths[0], args.binary, args.hex_file, args.force, args.relax, args.optimize, args.listing_file)]
+    else:
+        # only the command line needs a pool, and importing it pulls in multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        options = [[option] * len(sources) for option in (args.binary, args.hex_file, args.force, args.relax, args.optimize, args.listing_file)]
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(build_program, sources, paths, *options))
+
+    summary = {
+        "programs": results,
+        "errors": sum(1 for result in results if "error" in result),
+        "seconds": time.perf_counter() - start,
+    }
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+
+    return 1 if summary["errors"] else 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
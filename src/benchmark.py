@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks for the simulator and assembler. Every program in program/ is run headless
+# for a fixed number of instructions with scripted input on each engine, and the screen
+# decode, MIF loading and the assembler are timed. Results are written as JSON, which can
+# be compared with the results of an earlier run to catch regressions.
+
+import argparse
+import hashlib
+import json
+import pathlib
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import assembler
+import simulator
+
+# bump when the benchmarks change so results aren't compared across versions
+BENCHMARK_VERSION = 1
+
+# CPU options for each engine. "clock" is the reference one instruction at a time
+# CPU.clock(), which is slow enough to get a tenth of the budget
+ENGINES = {
+    "clock": {"translate": False, "skip_idle": False},
+    "interpret": {"translate": False, "skip_idle": False},
+    "translate": {"translate": True, "skip_idle": False},
+    "default": {"translate": True},
+}
+
+def best_time(function, repeat: int) -> float:
+    # fastest of repeat runs, in seconds
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def scripted_input(symbols: dict[str, int], budget: int, interval: int = 5000) -> list[tuple[int, tuple]]:
+    # input events for a program, in the format InputQueue.replay takes: every interval
+    # instructions the next arrow key is held down, and for programs with a mouse, it
+    # moves and alternately clicks and releases
+    keys = [symbols[name] for name in ("up", "right", "down", "left") if name in symbols]
+    mouse = all(name in symbols for name in ("mousex", "mousey", "mouseevent"))
+
+    events = []
+    for i, executed in enumerate(range(interval, budget, interval)):
+        writes = [(key, int(key == keys[i % len(keys)])) for key in keys]
+        if mouse:
+            writes += [(symbols["mousex"], i * 7 % 32), (symbols["mousey"], i * 13 % 32), (symbols["mouseevent"], i % 2)]
+        if writes:
+            events.append((executed, tuple(writes)))
+
+    return events
+
+def run_clock(cpu: simulator.CPU, events: list[tuple[int, tuple]], budget: int) -> None:
+    # CPU.clock() doesn't go through run_until, so the input is applied here
+    done = 0
+    for executed, writes in [event for event in events if event[0] < budget] + [(budget, ())]:
+        for _ in range(executed - done):
+            cpu.clock()
+        done = executed
+
+        for address, value in writes:
+            cpu.write_memory(address, value)
+
+def digest(cpu: simulator.CPU) -> str:
+    # memory and registers, so engines that stop at different points are told apart
+    # even when memory happens to be the same
+    registers = bytes([cpu.a, cpu.b]) + cpu.x.to_bytes(2, "little") + cpu.y.to_bytes(2, "little") + cpu.pc.to_bytes(2, "little")
+    return hashlib.sha256(bytes(cpu.memory) + registers).hexdigest()
+
+def run_engine(cpu: simulator.CPU, engine: str, events: list[tuple[int, tuple]], instructions: int) -> None:
+    # runs a freshly built cpu for instructions with events as its input, the same way
+    # for the timed runs and the runs that are only checked
+    if engine == "clock":
+        run_clock(cpu, events, instructions)
+    else:
+        cpu.input.replay(events)
+        cpu.run(instructions)
+
+def benchmark_programs(programs: list[pathlib.Path], budget: int, repeat: int) -> tuple[dict, list[str], list[str]]:
+    # instructions per second of every engine on every program. Also checks that every
+    # engine ends up with the same memory and registers: the fast engines given the whole
+    # budget against each other, and all of them given a tenth of it against the
+    # reference clock engine.
+    # Returns the results, the programs that faulted and the engines that disagreed
+    results = {}
+    errors = []
+    mismatches = []
+
+    for source in programs:
+        image = assembler.process_asm(assembler.read_asm(source))
+        events = scripted_input(image.symbols, budget)
+        digests = {}
+        reference = {}
+
+        for engine, options in ENGINES.items():
+            instructions = budget // 10 if engine == "clock" else budget
+
+            # built up front so only running them is timed
+            cpus = [simulator.CPU(image=image, **options) for _ in range(repeat)]
+            ran = []
+
+            def run() -> None:
+                cpu = cpus.pop()
+                ran.append(cpu)
+                run_engine(cpu, engine, events, instructions)
+
+            try:
+                seconds = best_time(run, repeat)
+            except ValueError as e:
+                errors.append(f"{source.stem} ({engine}): {e}")
+                break
+
+            results[f"{source.stem}.{engine}.ips"] = {"value": instructions / seconds, "unit": "instructions/s", "better": "higher"}
+
+            if engine == "clock":
+                reference[engine] = digest(ran[-1])
+            else:
+                digests[engine] = digest(ran[-1])
+                cpu = simulator.CPU(image=image, **options)
+                run_engine(cpu, engine, events, budget // 10)
+                reference[engine] = digest(cpu)
+
+        for name, compared in (("the whole budget", digests), ("a tenth of the budget", reference)):
+            if len(set(compared.values())) > 1:
+                mismatches.append(f"{source.stem}: engines disagree on memory and registers after {name}: {compared}")
+
+    return results, errors, mismatches
+
+def benchmark_screens(frames: int, repeat: int, screen_scale: int = 15) -> dict:
+    # time to decode and render one frame of each screen, the work display_screen and
+    # display_screen_2bit do for every frame they draw
+    import numpy as np
+
+    memory = bytearray(random.Random(0).randbytes(0x2000))
+    big = np.zeros((32 * screen_scale, 32 * screen_scale, 3), dtype=np.uint8)
+    results = {}
+
+    for screen, (decode, palette) in simulator.SCREENS.items():
+        palette = simulator.scale_palette(palette, screen_scale)
+
+        def render() -> None:
+            for _ in range(frames):
+                simulator.render_frame(decode(memory, 0x1000), palette, big)
+
+        results[f"screen{screen}.frame_us"] = {"value": best_time(render, repeat) / frames * 1e6, "unit": "us", "better": "lower"}
+
+    return results
+
+def benchmark_loading(program: pathlib.Path, repeat: int) -> dict:
+    # time to parse the program's rom.mif and ram.mif
+    with tempfile.TemporaryDirectory() as directory:
+        path = pathlib.Path(directory)
+        assembler.process_asm(assembler.read_asm(program), path=path)
+        cpu = simulator.CPU(rom=path / "rom.mif", ram=path / "ram.mif", cache=False)
+
+        def load() -> None:
+            cpu.load_memory_file(path / "rom.mif", 0x0000)
+            cpu.load_memory_file(path / "ram.mif", 0x1000)
+
+        return {"load_memory_file.ms": {"value": best_time(load, repeat) * 1000, "unit": "ms", "better": "lower"}}
+
+def synthetic_source(routines: int = 200) -> str:
+    # a program that fills most of ROM: routines that load, store, do arithmetic and
+    # branch to each other, plus some data
+    lines = ["data: equ $1100", "org $1200", "table: dc.b 1,2,3,4,5,6,7,8", "main:", "    org 0"]
+    for i in range(routines):
+        lines += [
+            f"routine{i}:",
+            f"    ldaa #{i % 256}",
+            "    staa data",
+            "    ldx #data",
+            "    ldab 0,x",
+            "    sum_ba",
+            f"    bne routine{(i + 1) % routines} ; next one",
+            f"    beq routine{i // 2}",
+        ]
+    return "\n".join(lines) + "\n"
+
+def benchmark_assembler(small: pathlib.Path, repeat: int) -> dict:
+    # in-memory assembly of a small program and of one that fills ROM, with nothing
+    # cached from earlier runs
+    results = {}
+
+    for name, source in (("small", small.read_text()), ("large", synthetic_source())):
+        lines = assembler.asm_lines(source)
+
+        def assemble() -> None:
+            assembler.parse_line.cache_clear()
+            assembler.process_asm(lines)
+
+        results[f"process_asm.{name}.ms"] = {"value": best_time(assemble, repeat) * 1000, "unit": "ms", "better": "lower"}
+
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    # every benchmark that got worse than in baseline by more than threshold (a fraction),
+    # and every one in baseline that's missing now, e.g. because it started faulting
+    regressions = [f"{name}: missing" for name in baseline["results"] if name not in results]
+
+    for name, result in results.items():
+        old = baseline["results"].get(name)
+        if old is None or old["value"] == 0:
+            continue
+
+        change = (result["value"] - old["value"]) / old["value"]
+        if result["better"] == "lower":
+            change = -change
+
+        print(f"{name:<36} {old['value']:>14,.2f} -> {result['value']:>14,.2f} {result['unit']:<15} {change:+.1%}")
+
+        if change < -threshold:
+            regressions.append(f"{name}: {change:+.1%}")
+
+    return regressions
+
+def main(argv: list[str] = None) -> int:
+    path = pathlib.Path(__file__).parent
+
+    parser = argparse.ArgumentParser(description="Benchmark the G-CPU simulator and assembler.")
+    parser.add_argument("-o", "--output", default=str(path.joinpath("benchmark.json")), help="where to write the results")
+    parser.add_argument("--budget", type=int, default=200_000, help="instructions to run each program for")
+    parser.add_argument("--frames", type=int, default=1000, help="frames to render for the screen benchmarks")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs of each benchmark, the fastest counts")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="slowdown (as a fraction) that counts as a regression")
+    args = parser.parse_args(argv)
+
+    programs = sorted(path.joinpath("program").glob("*.asm"))
+
+    results, errors, mismatches = benchmark_programs(programs, args.budget, args.repeat)
+    results.update(benchmark_screens(args.frames, args.repeat))
+    results.update(benchmark_loading(path.joinpath("program", "snake.asm"), args.repeat))
+    results.update(benchmark_assembler(path.joinpath("program", "etch-a-sketch.asm"), args.repeat))
+
+    output = {
+        "version": BENCHMARK_VERSION,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "budget": args.budget,
+        "results": results,
+        "errors": errors,
+        "mismatches": mismatches,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    for error in errors:
+        print(f"Error: {error}")
+    for mismatch in mismatches:
+        print(f"Mismatch: {mismatch}")
+
+    if args.compare is None:
+        for name, result in results.items():
+            print(f"{name:<36} {result['value']:>14,.2f} {result['unit']}")
+        return 1 if mismatches else 0
+
+    with open(args.compare, 'r') as f:
+        baseline = json.load(f)
+
+    if baseline.get("version") != BENCHMARK_VERSION:
+        print("Baseline is from a different version of the benchmarks, not comparing")
+        return 1 if mismatches else 0
+
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+
+    return 1 if regressions or mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Ahead-of-time version of translator.py: translates every block reachable from the
+# program's labels into one Python module, cached next to rom.mif and keyed by a hash
+# of the ROM image, so later runs of the same program skip translation entirely.
+
+import hashlib
+import importlib.util
+import json
+import pathlib
+
+from translator import BlockCache, find_block, generate_block
+
+# bump whenever the generated code changes so stale modules aren't picked up
+RECOMPILER_VERSION = 3
+
+
+def rom_hash(cpu) -> str:
+    image = bytes(cpu.memory[:0x1000])
+    return hashlib.sha256(image + f"v{RECOMPILER_VERSION}".encode()).hexdigest()[:16]
+
+
+def entry_points(symbols: dict[str, int], lines: dict[int, tuple[int, str]]) -> dict[int, list[str]]:
+    # every label that marks an instruction in ROM, plus the reset vector
+    entries = {0x0000: []}
+    for name, address in symbols.items():
+        if address < 0x1000 and address in lines:
+            entries.setdefault(address, []).append(name)
+    return entries
+
+
+def reachable_blocks(decoded: list, entries) -> list[int]:
+    # follow both sides of every branch from the entry points
+    seen = set()
+    pending = list(entries)
+
+    while pending:
+        pc = pending.pop()
+        if pc in seen or pc >= 0x1000 or decoded[pc] is None:
+            continue
+
+        seen.add(pc)
+
+        block = find_block(decoded, pc)
+        opcode, operand, next_pc = block[-1][1]
+
+        pending.append(next_pc)
+        if 0x20 <= opcode <= 0x27:
+            pending.append(operand)
+
+    return sorted(seen)
+
+
+def generate_module(cpu, symbols: dict[str, int], lines: dict[int, tuple[int, str]]) -> str:
+    entries = entry_points(symbols, lines)
+
+    source = f"# generated by recompiler.py from ROM {rom_hash(cpu)}, do not edit\n\n"
+    table = []
+
+    for pc in reachable_blocks(cpu.decoded, entries):
+        generated = generate_block(cpu.decoded, pc)
+        if generated is None:
+            continue
+
+        block, count, end = generated
+        labels = entries.get(pc)
+        if labels:
+            source += f"# {', '.join(labels)}\n"
+        source += block + "\n"
+        table.append(f"    {pc:#06x}: (block_{pc:04X}, {count}, {end:#06x}),\n")
+
+    source += "BLOCKS = {\n" + "".join(table) + "}\n"
+    return source
+
+
+def load_module(filename: pathlib.Path):
+    # importing through the regular loader also caches the bytecode in __pycache__
+    spec = importlib.util.spec_from_file_location(filename.stem, filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def recompile(cpu, path: str | pathlib.Path, symbols: dict[str, int] = None, lines: dict[int, tuple[int, str]] = None) -> pathlib.Path:
+    # loads (generating it first if needed) the recompiled module for the cpu's ROM from
+    # the directory at path, and fills the cpu's block cache with it
+    path = pathlib.Path(path)
+
+    if symbols is None or lines is None:
+        symbols, lines = {}, {}
+        if path.joinpath("symbols.dbg").exists():
+            with open(path.joinpath("symbols.dbg"), 'r') as f:
+                result = json.load(f)
+                symbols = result["symbols"]
+                lines = {int(key): value for key, value in result["lines"].items()}
+
+    filename = path.joinpath(f"rom_{rom_hash(cpu)}.py")
+
+    if not filename.exists():
+        # write then rename so a half-written module is never picked up
+        temporary = filename.with_suffix(".tmp")
+        with open(temporary, 'w') as f:
+            f.write(generate_module(cpu, symbols, lines))
+        temporary.replace(filename)
+
+    if cpu.blocks is None:
+        cpu.blocks = BlockCache(cpu)
+
+    cpu.blocks.blocks.update(load_module(filename).BLOCKS)
+    return filename
@@ -1,19 +1,159 @@
+from __future__ import annotations
+
 import re
-import cv2
-import numpy as np
-from pynput import keyboard
 import pathlib
 import threading
 import time
 import platform
 import json
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import math
+import mmap
+import struct
+import hashlib
+import bisect
+from typing import TYPE_CHECKING
+from assembler import Image
+from translator import BlockCache
+import recompiler
 
 # TODO: add comments & docstrings, make into CLI tool, add debug options 
 
+# cv2, numpy and pynput are slow to import (and pynput needs a display), so they're only
+# imported by the screen and input functions that use them, as is multiprocessing
+if TYPE_CHECKING:
+    import numpy as np
+
+# size of every instruction in bytes, used to predecode the ROM
+INSTRUCTION_SIZES = {
+    0x00: 1, 0x01: 1, 0x02: 2, 0x03: 2,
+    0x04: 3, 0x05: 3, 0x06: 3, 0x07: 3, 0x08: 3, 0x09: 3, 0x0A: 3, 0x0B: 3,
+    0x0C: 2, 0x0D: 2, 0x0E: 2, 0x0F: 2, 0x10: 2, 0x11: 2, 0x12: 2, 0x13: 2,
+    0x14: 1, 0x15: 1, 0x16: 1, 0x17: 1, 0x18: 1, 0x19: 1, 0x1A: 1, 0x1B: 1,
+    0x1C: 1, 0x1D: 1, 0x1E: 1, 0x1F: 1,
+    0x20: 2, 0x21: 2, 0x22: 2, 0x23: 2,
+    0x24: 3, 0x25: 3, 0x26: 3, 0x27: 3,
+    0x30: 1, 0x31: 1,
+}
+
+BRANCH_OPCODES = frozenset(range(0x20, 0x28))
+
+# memory initialization file entries, either "[start..end] : value;" or "address : value;"
+MIF_RANGE = re.compile(r"^\[([0-9A-Fa-f]+)\.\.([0-9A-Fa-f]+)\]\s*:\s*([0-9A-Fa-f]+);")
+MIF_SINGLE = re.compile(r"^([0-9A-Fa-f]+)\s*:\s*([0-9A-Fa-f]+);")
+
+# header of the binary image cached next to the MIF files: magic, then the
+# modification time (ns) and size of the rom and ram files it was built from
+MEMORY_CACHE_HEADER = struct.Struct("<8sQQQQ")
+MEMORY_CACHE_MAGIC = b"GCPUMEM1"
+
+# what an empty ROM decodes to, every address a tab
+ZEROS_DECODED = [(0x00, 0, address + 1) for address in range(0x1000)]
+
+# input recordings: magic and the number of instructions the recording covers, then
+# for every event the instruction count it was applied at and how many writes it has,
+# followed by the address and value of each write
+RECORDING_HEADER = struct.Struct("<8sQ")
+RECORDING_EVENT = struct.Struct("<QB")
+RECORDING_WRITE = struct.Struct("<HB")
+RECORDING_MAGIC = b"GCPUREC1"
+
+class InputQueue:
+    # input events from the window and keyboard threads. Each event is a group of
+    # (address, value) writes that are applied together, by the cpu's own thread between
+    # batches of instructions, so nothing writes to memory while it's running. When full,
+    # the queued events are merged into one that writes the last value queued for each
+    # address, which leaves memory as if they'd all been applied, since they would have
+    # been applied back to back anyway.
+    # Applied events can be recorded with the instruction count they were applied at, and
+    # a recording can be replayed, in which case the cpu stops at exactly those counts
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.events = deque()
+        self.lock = threading.Lock()
+        self.recording = None
+        self.scheduled = deque()
+
+    def put(self, *writes: tuple[int, int]) -> None:
+        with self.lock:
+            if len(self.events) >= self.size:
+                merged = {}
+                for event in self.events:
+                    merged.update(event)
+                merged.update(writes)
+
+                self.events.clear()
+                writes = tuple(merged.items())
+
+            self.events.append(writes)
+
+    def record(self) -> None:
+        self.recording = []
+
+    def replay(self, events: list[tuple[int, tuple]]) -> None:
+        self.scheduled = deque(events)
+
+    def next_event(self) -> int | None:
+        # instruction count the next replayed event is due at
+        return self.scheduled[0][0] if self.scheduled else None
+
+    def drain(self, cpu) -> None:
+        while self.scheduled and self.scheduled[0][0] <= cpu.executed:
+            self.apply(cpu, self.scheduled.popleft()[1])
+
+        if self.events:
+            with self.lock:
+                events = list(self.events)
+                self.events.clear()
+
+            for writes in events:
+                self.apply(cpu, writes)
+
+    def apply(self, cpu, writes: tuple) -> None:
+        for address, value in writes:
+            cpu.write_memory(address, value)
+
+        if self.recording is not None:
+            self.recording.append((cpu.executed, writes))
+
+def save_recording(filename: str | pathlib.Path, events: list[tuple[int, tuple]], length: int) -> None:
+    with open(filename, 'wb') as f:
+        f.write(RECORDING_HEADER.pack(RECORDING_MAGIC, length))
+        for executed, writes in events:
+            f.write(RECORDING_EVENT.pack(executed, len(writes)))
+            for address, value in writes:
+                f.write(RECORDING_WRITE.pack(address, value))
+
+def load_recording(filename: str | pathlib.Path) -> tuple[list[tuple[int, tuple]], int]:
+    # returns the events and the number of instructions the recording covers
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    magic, length = RECORDING_HEADER.unpack_from(data)
+    if magic != RECORDING_MAGIC:
+        raise ValueError("Not an input recording")
+
+    events = []
+    offset = RECORDING_HEADER.size
+    while offset < len(data):
+        executed, count = RECORDING_EVENT.unpack_from(data, offset)
+        offset += RECORDING_EVENT.size
+        writes = tuple(RECORDING_WRITE.unpack_from(data, offset + i * RECORDING_WRITE.size) for i in range(count))
+        offset += count * RECORDING_WRITE.size
+        events.append((executed, writes))
+
+    return events, length
+
+class Profile:
+    # how many times each instruction ran, by address and by opcode, and how many times
+    # each branch was taken
+    def __init__(self):
+        self.pcs = [0] * 0x2000
+        self.opcodes = [0] * 0x100
+        self.taken = [0] * 0x2000
+
 class CPU:
-    def __init__(self, rom: str = "rom.mif", ram: str = "ram.mif"):
+    def __init__(self, rom: str = "rom.mif", ram: str = "ram.mif", translate: bool = False, cache: bool = True, image=None, skip_idle: bool = True, profile: bool = False):
         self.a = 0
         self.b = 0
 
@@ -22,9 +162,39 @@ class CPU:
 
         self.pc = 0
         
-        self.memory = [0] * 0x2000 # 4Kib ROM, 4Kib RAM
+        self.memory = bytearray(0x2000) # 4Kib ROM, 4Kib RAM
+
+        # write counter for every 256 byte page of memory
+        self.generations = [0] * (0x2000 >> 8)
+
+        self.blocks = None
+
+        # labels and source lines, when the program came from an assembler Image
+        self.symbols = {}
+        self.lines = {}
+
+        # input from other threads, written to memory between runs of instructions
+        self.input = InputQueue()
+
+        # instructions run through run_until so far, which is what input is timed by
+        self.executed = 0
+
+        # fast-forward through loops that are only waiting for input (see skip_idle_loop).
+        # quiet is set after a whole batch that didn't write to memory, when the program
+        # might be waiting in one
+        self.skip_idle = skip_idle
+        self.quiet = False
+
+        # execution counts, only kept (on a slower engine) when profiling
+        self.profile = Profile() if profile else None
 
-        self.load_memory(rom, ram)
+        if image is not None:
+            self.load_image(image)
+        else:
+            self.load_memory(rom, ram, cache)
+
+        if translate:
+            self.blocks = BlockCache(self)
 
         self.instructions = {
             0x00: Instruction.tab,
@@ -74,9 +244,11 @@ class CPU:
         }
 
     def load_memory_file(self, filename: str, offset: int):
+        # the predecoded ROM and translated blocks are redone afterwards, so loading a new
+        # program into a cpu that has already run one is safe
         with open(filename, 'r') as f:
             start_loading = False
-            for line in f.readlines():
+            for line in f:
                 line = line.strip()
                 
                 if line == "BEGIN":
@@ -88,21 +260,19 @@ class CPU:
                 
                 if start_loading and line:
                     # ranged memory
-                    ranged_memory = re.match(r"^\[([0-9A-Fa-f]+)\.\.([0-9A-Fa-f]+)\]\s*\t*:\s*\t*([0-9A-Fa-f]+);.*$", line)
+                    ranged_memory = MIF_RANGE.match(line)
 
                     if ranged_memory:
                         start, end, value = ranged_memory.groups()
-                        start = int(start, 16)
-                        end = int(end, 16)
-                        value = int(value, 16)
+                        start = int(start, 16) + offset
+                        end = int(end, 16) + offset
 
-                        for address in range(start, end + 1):
-                            self.memory[address + offset] = value
+                        self.memory[start:end + 1] = bytes([int(value, 16)]) * (end + 1 - start)
 
                         continue
                     
                     # single memory
-                    single_memory = re.match(r"^([0-9A-Fa-f]+)\s*\t*:\s*\t*([0-9A-Fa-f]+);.*$", line)
+                    single_memory = MIF_SINGLE.match(line)
                     if single_memory:
                         address, value = single_memory.groups()
                         address = int(address, 16)
@@ -110,10 +280,108 @@ class CPU:
 
                         self.memory[address + offset] = value
 
+        self.memory_replaced()
+
+    def memory_cache_header(self, rom: str, ram: str) -> bytes:
+        rom_stat = pathlib.Path(rom).stat()
+        ram_stat = pathlib.Path(ram).stat()
+        return MEMORY_CACHE_HEADER.pack(MEMORY_CACHE_MAGIC, rom_stat.st_mtime_ns, rom_stat.st_size, ram_stat.st_mtime_ns, ram_stat.st_size)
+
+    def load_memory(self, rom: str, ram: str, cache: bool = True):
+        # parsing the MIF files is slow, so the result is cached as a raw image next to the
+        # rom file and reused for as long as neither file changes
+        cache_file = pathlib.Path(rom).with_suffix(".cache")
+        header = self.memory_cache_header(rom, ram)
 
-    def load_memory(self, rom: str, ram: str):
-        self.load_memory_file(rom, 0x0000)
-        self.load_memory_file(ram, 0x1000)
+        image = None
+        if cache and cache_file.exists():
+            with open(cache_file, 'rb') as f:
+                image = f.read()
+
+        if image is not None and image[:len(header)] == header and len(image) == len(header) + len(self.memory):
+            self.memory[:] = image[len(header):]
+            self.memory_replaced()
+        else:
+            # each of these calls memory_replaced
+            self.load_memory_file(rom, 0x0000)
+            self.load_memory_file(ram, 0x1000)
+
+            if cache:
+                try:
+                    with open(cache_file, 'wb') as f:
+                        f.write(header + self.memory)
+                except OSError:
+                    # read only location, just parse every time
+                    pass
+
+    def load_image(self, image) -> None:
+        # flat 8 KiB image of the whole address space (memory.bin from the assembler), or
+        # the Image process_asm returns. A bytearray or mmap is used as memory directly, and
+        # a filename is mapped copy on write, so processes running the same image share it
+        # until they write to it. A memoryview (e.g. of shared memory) is used directly too
+        if isinstance(image, Image):
+            self.symbols = image.symbols
+            self.lines = image.lines
+            image = bytearray(bytes(image))
+        elif isinstance(image, (str, pathlib.Path)):
+            with open(image, 'rb') as f:
+                image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        elif not isinstance(image, (bytearray, mmap.mmap, memoryview)):
+            image = bytearray(image)
+
+        if len(image) != 0x2000:
+            raise ValueError("Memory image must be 8 KiB")
+
+        self.memory = image
+        self.memory_replaced()
+
+    def memory_replaced(self) -> None:
+        self.decode_rom()
+
+        for page in range(len(self.generations)):
+            self.generations[page] += 1
+
+    def decode(self, address: int) -> tuple[int, int, int] | None:
+        # returns (opcode, operand, next pc) for the instruction at address, or None if
+        # it has to go through clock() instead (unknown opcode, spills into RAM, or faults)
+        opcode = self.memory[address]
+        size = INSTRUCTION_SIZES.get(opcode)
+        if size is None or address + size > 0x1000:
+            return None
+
+        next_pc = address + size
+
+        if size == 1:
+            return (opcode, 0, next_pc)
+
+        low = self.memory[address + 1]
+
+        if size == 2:
+            if 0x20 <= opcode <= 0x23:
+                # 8-bit branches replace the low byte of the pc (which points at the operand)
+                return (opcode, ((address + 1) & 0xFF00) | low, next_pc)
+            return (opcode, low, next_pc)
+
+        operand = (self.memory[address + 2] << 8) | low
+
+        # leave absolute accesses that would fault to clock() so the error matches
+        if opcode in (0x04, 0x05) and operand >= 0x2000:
+            return None
+        if opcode in (0x06, 0x07) and not 0x1000 <= operand < 0x2000:
+            return None
+        if opcode in (0x0A, 0x0B) and operand + 1 >= 0x2000:
+            return None
+
+        return (opcode, operand, next_pc)
+
+    def decode_rom(self) -> None:
+        # ROM can't be written to, so it only ever has to be decoded once. Programs rarely
+        # fill it, and the zeros after the end of the program all decode to tab
+        end = len(bytes(self.memory[:0x1000]).rstrip(b"\0"))
+        self.decoded = [self.decode(address) for address in range(end)] + ZEROS_DECODED[end:]
+
+        if self.blocks is not None:
+            self.blocks.clear()
 
     def get_memory(self, address: int = None) -> int:
         if address is None:
@@ -132,6 +400,12 @@ class CPU:
             raise ValueError("Cannot write to ROM")
         
         self.memory[address] = value
+        self.generations[address >> 8] += 1
+
+    def region_generation(self, start: int, end: int) -> int:
+        # changes whenever anything from start to end (inclusive) is written, so consumers
+        # can tell whether a region needs to be looked at again
+        return sum(self.generations[start >> 8:(end >> 8) + 1])
         
     def inc_pc(self) -> None:
         self.pc += 1
@@ -145,6 +419,249 @@ class CPU:
         else:
             raise ValueError(f"Unknown instruction: ${instruction:02X}")
 
+    def run(self, max_instructions: int) -> tuple[int, str]:
+        return self.run_until(max_instructions=max_instructions)
+
+    def run_until(self, pcs=None, max_instructions: int = None, stop_flag=None, batch: int = 1000) -> tuple[int, str]:
+        # runs until the pc lands on one of pcs (after at least one instruction), until
+        # max_instructions have run, or until stop_flag() returns True, which is checked
+        # every batch instructions. Returns how many instructions ran and why it stopped:
+        # "breakpoint", "limit" or "stopped"
+        stops = frozenset(pcs) if pcs else None
+        executed = 0
+
+        # breakpoints could be skipped over, so no fast-forwarding with those, and the
+        # profile has to see every instruction
+        skip_idle = self.skip_idle and stops is None and self.profile is None
+
+        while True:
+            if stop_flag is not None and stop_flag():
+                return executed, "stopped"
+
+            count = batch
+            if max_instructions is not None:
+                count = min(batch, max_instructions - executed)
+                if count <= 0:
+                    return executed, "limit"
+
+            if self.input.events or self.input.scheduled:
+                self.input.drain(self)
+
+                # stop right where the next replayed event is due
+                due = self.input.next_event()
+                if due is not None:
+                    count = min(count, due - self.executed)
+
+            if skip_idle and self.quiet:
+                ran = self.skip_idle_loop(count)
+                executed += ran
+                self.executed += ran
+                count -= ran
+                if count == 0:
+                    continue
+
+            generation = sum(self.generations) if skip_idle else None
+
+            ran = self.execute(count, stops)
+            executed += ran
+            self.executed += ran
+
+            self.quiet = skip_idle and ran == count and sum(self.generations) == generation
+
+            if stops is not None and self.pc in stops:
+                return executed, "breakpoint"
+
+    def skip_idle_loop(self, count: int, probe: int = 512) -> int:
+        # steps through up to probe instructions looking for the cpu coming back to the same
+        # pc and registers without writing to memory. Memory only changes between batches
+        # (input is applied by run_until), so from then on it would go round the same loop
+        # until count runs out, and that many instructions are counted as run without
+        # running them. Returns how many instructions ran or were skipped
+        seen = {}
+        generation = sum(self.generations)
+        steps = 0
+
+        while steps < min(count, probe):
+            state = (self.pc, self.a, self.b, self.x, self.y)
+            if state in seen:
+                period = steps - seen[state]
+                return steps + (count - steps) // period * period
+            seen[state] = steps
+
+            steps += self.interpret(1)
+
+            if sum(self.generations) != generation:
+                break
+
+        return steps
+
+    def execute(self, count: int, stops: frozenset[int] = None) -> int:
+        # runs up to count instructions on the fastest engine available, stopping early
+        # if the pc lands on one of stops
+        if self.profile is not None:
+            return self.profile_execute(count, stops)
+
+        if self.blocks is not None:
+            return self.blocks.execute(count, stops)
+
+        return self.interpret(count, stops)
+
+    def profile_execute(self, count: int, stops: frozenset[int] = None) -> int:
+        # execute(), one instruction at a time, counting each one in the profile
+        pcs = self.profile.pcs
+        opcodes = self.profile.opcodes
+        taken = self.profile.taken
+        memory = self.memory
+        executed = 0
+
+        while executed < count:
+            pc = self.pc
+            if executed and stops and pc in stops:
+                break
+
+            opcode = None
+            if pc < 0x2000:
+                opcode = memory[pc]
+                pcs[pc] += 1
+                opcodes[opcode] += 1
+
+            executed += self.interpret(1)
+
+            if opcode in BRANCH_OPCODES and self.pc != pc + INSTRUCTION_SIZES[opcode]:
+                taken[pc] += 1
+
+        return executed
+
+    def interpret(self, count: int, stops: frozenset[int] = None) -> int:
+        # fast path for clock(): runs up to count instructions from the predecoded ROM
+        # with the registers held in locals. Anything that isn't predecoded (code in RAM,
+        # unknown opcodes) falls back to clock(). Returns the number of instructions run.
+        decoded = self.decoded
+        memory = self.memory
+        generations = self.generations
+        a, b, x, y, pc = self.a, self.b, self.x, self.y, self.pc
+        executed = 0
+
+        if stops:
+            # knock the stops out of the table so they're checked on the slow path only
+            decoded = decoded.copy()
+            for stop in stops:
+                if stop < 0x1000:
+                    decoded[stop] = None
+
+        try:
+            for executed in range(1, count + 1):
+                entry = decoded[pc] if pc < 0x1000 else None
+
+                if entry is None:
+                    if stops and executed > 1 and pc in stops:
+                        executed -= 1
+                        break
+
+                    self.a, self.b, self.x, self.y, self.pc = a, b, x, y, pc
+                    self.clock()
+                    a, b, x, y, pc = self.a, self.b, self.x, self.y, self.pc
+                    continue
+
+                op, operand, next_pc = entry
+
+                if op < 0x14:
+                    if op < 0x0C:
+                        if op < 0x04:
+                            if op == 0x00:
+                                b = a
+                            elif op == 0x01:
+                                a = b
+                            elif op == 0x02:
+                                a = operand
+                            else:
+                                b = operand
+                        elif op < 0x08:
+                            if op == 0x04:
+                                a = memory[operand]
+                            elif op == 0x05:
+                                b = memory[operand]
+                            elif op == 0x06:
+                                memory[operand] = a
+                                generations[operand >> 8] += 1
+                            else:
+                                memory[operand] = b
+                                generations[operand >> 8] += 1
+                        elif op == 0x08:
+                            x = operand
+                        elif op == 0x09:
+                            y = operand
+                        elif op == 0x0A:
+                            x = memory[operand] | (memory[operand + 1] << 8)
+                        else:
+                            y = memory[operand] | (memory[operand + 1] << 8)
+                    else:
+                        # odd opcodes index off y, even ones off x
+                        address = ((y if op & 1 else x) + operand) & 0xFFFF
+                        if op < 0x0E:
+                            a = memory[address]
+                        elif op < 0x10:
+                            b = memory[address]
+                        elif address < 0x1000:
+                            raise ValueError("Cannot write to ROM")
+                        elif op < 0x12:
+                            memory[address] = a
+                            generations[address >> 8] += 1
+                        else:
+                            memory[address] = b
+                            generations[address >> 8] += 1
+                elif op < 0x20:
+                    if op == 0x14:
+                        a = (a + b) & 0xFF
+                    elif op == 0x15:
+                        b = (a + b) & 0xFF
+                    elif op == 0x16:
+                        a = a & b
+                    elif op == 0x17:
+                        b = a & b
+                    elif op == 0x18:
+                        a = a | b
+                    elif op == 0x19:
+                        b = a | b
+                    elif op == 0x1A:
+                        a = ~a & 0xFF
+                    elif op == 0x1B:
+                        b = ~b & 0xFF
+                    elif op == 0x1C:
+                        a = (a << 1) & 0xFF
+                    elif op == 0x1D:
+                        a >>= 1
+                    elif op == 0x1E:
+                        b = (b << 1) & 0xFF
+                    else:
+                        b >>= 1
+                elif op < 0x28:
+                    # beq, bne, bn, bp (both 8-bit and 16-bit), target is already resolved
+                    condition = op & 3
+                    if condition == 0:
+                        taken = a == 0
+                    elif condition == 1:
+                        taken = a != 0
+                    elif condition == 2:
+                        taken = a & 0x80
+                    else:
+                        taken = not a & 0x80
+
+                    if taken:
+                        next_pc = operand
+                elif op == 0x30:
+                    x = (x + 1) & 0xFFFF
+                else:
+                    y = (y + 1) & 0xFFFF
+
+                pc = next_pc
+        except IndexError:
+            raise ValueError("Memory address is out of bounds") from None
+        finally:
+            self.a, self.b, self.x, self.y, self.pc = a, b, x, y, pc
+
+        return executed
+
 
 class Instruction:
     def tab(cpu: CPU):
@@ -510,82 +1027,279 @@ def display_info(cpu: CPU, memory_locations: dict[str, int] = None) -> None:
           f"{'\n'.join(locations)}\n",
           sep="\n")
 
-def display_screen(cpu: CPU, start: int = 0x1000, screen_scale: int = 1) -> bool:
-    global run_program
-    while run_program:
-        for i in range(128):
-            byte = cpu.memory[start + i]
-            for j in range(8):
-                val = i * 8 + j
-                bit = (byte >> (7 - j)) & 1
-                buffer[val // 32, val % 32] = (0,0,0) if bit == 0 else (255, 255, 255)
-        
-        big = cv2.resize(
-            buffer,
-            (buffer.shape[1] * screen_scale, buffer.shape[0] * screen_scale),
-            interpolation=cv2.INTER_NEAREST
+# BGR colors for each pixel value
+PALETTE_1BIT = [(0, 0, 0), (255, 255, 255)]
+PALETTE_2BIT = [(0, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)]
+
+def decode_screen(memory, start: int = 0x1000) -> np.ndarray:
+    # 1 bit per pixel, most significant bit first, 128 bytes for a 32x32 screen
+    import numpy as np
+    video = np.frombuffer(memory, dtype=np.uint8, count=128, offset=start)
+    return np.unpackbits(video).reshape(32, 32)
+
+def decode_screen_2bit(memory, start: int = 0x1000) -> np.ndarray:
+    # 2 bits per pixel, most significant pair first, 256 bytes for a 32x32 screen
+    import numpy as np
+    video = np.frombuffer(memory, dtype=np.uint8, count=256, offset=start)
+    pairs = np.unpackbits(video).reshape(1024, 2)
+    return ((pairs[:, 0] << 1) | pairs[:, 1]).reshape(32, 32)
+
+def scale_palette(palette: list[tuple[int, int, int]], screen_scale: int) -> np.ndarray:
+    # each color repeated screen_scale times across, for render_frame
+    import numpy as np
+    return np.tile(np.array(palette, dtype=np.uint8), (1, screen_scale))
+
+def render_frame(pixels: np.ndarray, palette: np.ndarray, out: np.ndarray) -> np.ndarray:
+    # looks the pixels up in a scaled palette and upscales them into out. Each pixel comes
+    # out of the palette already repeated across, so every row of pixels is one row of
+    # out that only has to be copied down
+    import numpy as np
+    rows = pixels.shape[0]
+    scale = out.shape[0] // rows
+    wide = np.take(palette, pixels, axis=0)
+    out.reshape(rows, scale, -1)[:] = wide.reshape(rows, 1, -1)
+    return out
+
+SCREENS = {
+    1: (decode_screen, PALETTE_1BIT),
+    2: (decode_screen_2bit, PALETTE_2BIT),
+}
+
+# Frame sinks: anything with write(frame) and close() can be handed rendered frames
+
+class WindowSink:
+    def __init__(self, screen_scale: int = 1, name: str = "screen"):
+        import cv2
+        self.name = name
+
+        cv2.namedWindow(
+            name,
+            cv2.WINDOW_NORMAL    |
+            cv2.WINDOW_GUI_NORMAL
+        )
+        cv2.setWindowProperty(
+            name,
+            cv2.WND_PROP_ASPECT_RATIO,
+            cv2.WINDOW_KEEPRATIO
         )
 
-        cv2.imshow("screen", big)
+        cv2.resizeWindow(name, 32 * screen_scale, 32 * screen_scale)
+
+    def write(self, frame: np.ndarray) -> None:
+        import cv2
+        cv2.imshow(self.name, frame)
+
+    def close(self) -> None:
+        import cv2
+        cv2.destroyWindow(self.name)
+
+class PngSink:
+    # numbered PNG files in a directory
+    def __init__(self, directory: str | pathlib.Path):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.count = 0
+
+    def write(self, frame: np.ndarray) -> None:
+        import cv2
+        cv2.imwrite(str(self.directory / f"frame_{self.count:06d}.png"), frame)
+        self.count += 1
+
+    def close(self) -> None:
+        pass
+
+class RawSink:
+    # frames as raw BGR bytes, back to back in one file
+    def __init__(self, filename: str | pathlib.Path):
+        self.file = open(filename, 'wb')
+
+    def write(self, frame: np.ndarray) -> None:
+        self.file.write(frame.tobytes())
+
+    def close(self) -> None:
+        self.file.close()
+
+class VideoSink:
+    def __init__(self, filename: str | pathlib.Path, fps: float = 30, codec: str = "mp4v"):
+        self.filename = str(filename)
+        self.fps = fps
+        self.codec = codec
+        self.writer = None
+
+    def write(self, frame: np.ndarray) -> None:
+        import cv2
+        if self.writer is None:
+            # the frame size is only known once the first frame comes in
+            height, width = frame.shape[:2]
+            self.writer = cv2.VideoWriter(self.filename, cv2.VideoWriter_fourcc(*self.codec), self.fps, (width, height))
+        self.writer.write(frame)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.release()
+
+def percentile(values: list[float], percent: float) -> float:
+    # the value percent of the way through values, which must be sorted
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, round(percent / 100 * (len(values) - 1)))]
+
+def display_screen(cpu: CPU, start: int = 0x1000, screen_scale: int = 1, decode=decode_screen, palette: list[tuple[int, int, int]] = PALETTE_1BIT, sinks: list = None, fps: float = 60, skip_frames: bool = True, stats: dict = None) -> bool:
+    # shows the screen at up to fps frames per second, waiting for input in between. A
+    # frame is only drawn if the screen has been written to since the last one. If drawing
+    # falls behind, the missed frames are dropped with skip_frames, otherwise they're
+    # drawn back to back to catch up. With fps = None, the screen is checked as often as
+    # possible. Frame counts and timings go in stats if it's given
+    import cv2
+    import numpy as np
+    global run_program
 
-        key = chr(cv2.waitKey(1) & 0xFF)
+    if sinks is None:
+        sinks = [WindowSink(screen_scale)]
 
-        if key == 'q':
-            run_program = False
-            return True
-        
-        if cv2.getWindowProperty('screen', cv2.WND_PROP_VISIBLE) < 1:
-            # window was closed manually
-            run_program = False
-            break
+    palette = scale_palette(palette, screen_scale)
+    big = np.zeros((32 * screen_scale, 32 * screen_scale, 3), dtype=np.uint8)
 
-def display_screen_2bit(cpu: CPU, start: int = 0x1000, screen_scale: int = 1) -> bool:
-    global run_program
+    # both screens fit in the page at start, redraw only when it's been written to
+    generation = None
+
+    frame_time = 1 / fps if fps else 0
+    begin = time.perf_counter()
+    deadline = begin
+    frame_times = []  # seconds spent drawing each frame
+    skipped = 0
+    quitting = False
 
-    display_map = [(0, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 255)]
     while run_program:
-        for i in range(256):
-            byte = cpu.memory[start + i]
-            for j in range(0, 8, 2):
-                val = i * 4 + j // 2
-                high_bit = ((byte >> (7 - j)) & 1) << 1
-                low_bit =  (byte >> (7 - (j + 1))) & 1
-
-                buffer[val // 32, val % 32] = display_map[high_bit | low_bit]
-        
-        big = cv2.resize(
-            buffer,
-            (buffer.shape[1] * screen_scale, buffer.shape[0] * screen_scale),
-            interpolation=cv2.INTER_NEAREST
-        )
+        now = time.perf_counter()
 
-        cv2.imshow("screen", big)
+        if cpu.region_generation(start, start + 0xFF) != generation:
+            generation = cpu.region_generation(start, start + 0xFF)
+            render_frame(decode(cpu.memory, start), palette, big)
 
-        key = chr(cv2.waitKey(1) & 0xFF)
+            for sink in sinks:
+                sink.write(big)
+
+            frame_times.append(time.perf_counter() - now)
+
+        now = time.perf_counter()
+
+        if not fps:
+            deadline = now
+        else:
+            deadline += frame_time
+
+            if skip_frames and now - deadline > frame_time:
+                # behind by more than a frame, drop the ones that were missed
+                missed = int((now - deadline) / frame_time)
+                skipped += missed
+                deadline += missed * frame_time
+
+        # waiting for input is the wait until the next frame
+        while True:
+            key = chr(cv2.waitKey(max(1, int((deadline - time.perf_counter()) * 1000))) & 0xFF)
+
+            if key == 'q':
+                run_program = False
+                quitting = True
+                break
+
+            if time.perf_counter() >= deadline:
+                break
+
+        if quitting:
+            break
 
-        if key == 'q':
-            run_program = False
-            return True
-        
         if cv2.getWindowProperty('screen', cv2.WND_PROP_VISIBLE) < 1:
             # window was closed manually
             run_program = False
             break
 
+    if stats is not None:
+        elapsed = time.perf_counter() - begin
+        frame_times.sort()
+        stats.update({
+            "frames": len(frame_times),
+            "skipped": skipped,
+            "seconds": elapsed,
+            "target_fps": fps,
+            "fps": len(frame_times) / elapsed if elapsed > 0 else 0.0,
+            "frame_ms": {f"p{p}": percentile(frame_times, p) * 1000 for p in (50, 90, 99)},
+        })
+
+    return quitting
+
+def report_frames(stats: dict) -> None:
+    frame_ms = ", ".join(f"{name} {ms:.2f} ms" for name, ms in stats["frame_ms"].items())
+    print(f"Display: {stats['fps']:.1f} fps (target {stats['target_fps']}), {stats['skipped']} frames skipped, frame time {frame_ms}")
+
+def display_screen_2bit(cpu: CPU, start: int = 0x1000, screen_scale: int = 1, sinks: list = None, fps: float = 60, skip_frames: bool = True, stats: dict = None) -> bool:
+    return display_screen(cpu, start, screen_scale, decode=decode_screen_2bit, palette=PALETTE_2BIT, sinks=sinks, fps=fps, skip_frames=skip_frames, stats=stats)
+
+def capture_screen(cpu: CPU, sinks: list, screen: int = 1, start: int = 0x1000, screen_scale: int = 1, interval: int = 10000, frames: int = None) -> int:
+    # runs the cpu without any GUI, rendering a frame to every sink each interval
+    # instructions, until frames frames have been written or the program is stopped.
+    # Returns the number of frames written
+    import numpy as np
+    decode, palette = SCREENS[screen]
+    palette = scale_palette(palette, screen_scale)
+    big = np.zeros((32 * screen_scale, 32 * screen_scale, 3), dtype=np.uint8)
+
+    count = 0
+    try:
+        while run_program and (frames is None or count < frames):
+            cpu.run(interval)
+            render_frame(decode(cpu.memory, start), palette, big)
+
+            for sink in sinks:
+                sink.write(big)
+            count += 1
+    finally:
+        for sink in sinks:
+            sink.close()
+
+    return count
+
+def replay_input(cpu: CPU, filename: str | pathlib.Path, sinks: list = None, screen: int = 0, screen_scale: int = 1, interval: int = 10000) -> str:
+    # reruns a recorded session at full speed with no window, applying every input event
+    # at the instruction count it was recorded at, and capturing the screen to sinks every
+    # interval instructions. Returns a hash of memory at the end, which matches the
+    # recorded session's
+    events, length = load_recording(filename)
+    cpu.input.replay(events)
+
+    if screen and sinks:
+        capture_screen(cpu, sinks, screen, screen_scale=screen_scale, interval=interval, frames=length // interval)
+
+    cpu.run(length - cpu.executed)
+
+    digest = hashlib.sha256(bytes(cpu.memory)).hexdigest()
+    print(f"Replayed {len(events)} input events over {cpu.executed:,} instructions, memory {digest[:16]}")
+    return digest
+
 def register_mouse(cpu: CPU, screen_scale: int, start: int = 0x1405):
+    import cv2
     x_pos = start
     y_pos = start + 1
     event_pos = start + 2
 
     def on_mouse(event, x, y, flags, param):
-        cpu.write_memory(x_pos, x // screen_scale)
-        cpu.write_memory(y_pos, y // screen_scale)
-        cpu.write_memory(event_pos, event)
+        # memory only holds bytes
+        cpu.input.put((x_pos, (x // screen_scale) & 0xFF), (y_pos, (y // screen_scale) & 0xFF), (event_pos, event & 0xFF))
 
     cv2.setMouseCallback("screen", on_mouse)
 
-def register_keys(cpu: CPU, start: int = 0x1400, sticky: bool = False) -> threading.Thread:
-    # TODO: fix memory leak with threads
+# key -> offset of the byte it sets, from the arrow keys' io address
+DEFAULT_KEYS = {"up": 0, "left": 1, "down": 2, "right": 3}
+
+def register_keys(cpu: CPU, start: int = 0x1400, sticky: bool = False, keys: dict[str, int] = None) -> threading.Thread:
+    # starts the keyboard listener, which lasts until it's stopped with .stop()
+    from pynput import keyboard
+
+    # keys are named after pynput's special keys (up, space, ...) or are single characters
+    if keys is None:
+        keys = DEFAULT_KEYS
+    keys = {getattr(keyboard.Key, name) if len(name) > 1 else keyboard.KeyCode.from_char(name): idx for name, idx in keys.items()}
 
 
     def on_press(key):
@@ -596,11 +1310,9 @@ def register_keys(cpu: CPU, start: int = 0x1400, sticky: bool = False) -> thread
         idx = keys[key]
 
         if not sticky:
-            cpu.memory[start + idx] = 1
+            cpu.input.put((start + idx, 1))
         else:
-            for i in range(len(keys)):
-                cpu.memory[start + i] = 0
-            cpu.memory[start + idx] = 1
+            cpu.input.put(*[(start + i, int(i == idx)) for i in range(len(keys))])
 
         
     def on_release(key):
@@ -609,9 +1321,107 @@ def register_keys(cpu: CPU, start: int = 0x1400, sticky: bool = False) -> thread
         idx = keys[key]
 
         if not sticky:
-            cpu.memory[start + idx] = 0
+            cpu.input.put((start + idx, 0))
+
+    listener = keyboard.Listener(on_press=on_press, on_release=on_release)
+    listener.start()
+    return listener
+
+# Render process: the screen and input run in another process, which sees the cpu's memory
+# through shared memory, so they don't hold the GIL the cpu needs
+
+class SharedMemoryView:
+    # what the screen and input functions need of a cpu, for a process that only has its
+    # memory. Writes from other processes can't be counted, so the screen region is
+    # compared with what was drawn last instead
+    def __init__(self, memory):
+        self.memory = memory
+        # input goes straight into memory, the cpu's process can't be asked to do it
+        self.input = self
+
+    def put(self, *writes: tuple[int, int]) -> None:
+        for address, value in writes:
+            self.memory[address] = value
+
+    def region_generation(self, start: int, end: int) -> bytes:
+        return bytes(self.memory[start:end + 1])
+
+def stop_on_event(event) -> None:
+    # stops this process' cpu or screen when another process sets event
+    global run_program
+    event.wait()
+    run_program = False
+
+def render_screen(name: str, stop, screen: int, screen_scale: int = 1, io_address: int = None, sticky: bool = False, keys: dict[str, int] = None, sinks: list = None, fps: float = 60, skip_frames: bool = True, report: bool = False) -> None:
+    # body of the render process: shows the screen from the shared memory called name and
+    # writes input into it until stop is set, or sets stop if the window is closed
+    import cv2
+    from multiprocessing import shared_memory
+
+    memory = shared_memory.SharedMemory(name=name)
+    view = SharedMemoryView(memory.buf)
+    threading.Thread(target=stop_on_event, args=(stop,), daemon=True).start()
+
+    try:
+        sinks = [WindowSink(screen_scale)] + (sinks or [])
+
+        listener = None
+        if io_address is not None:
+            listener = register_keys(view, start=io_address+3, sticky=sticky, keys=keys)
+            register_mouse(view, start=io_address, screen_scale=screen_scale)
+
+        decode, palette = SCREENS[screen]
+        stats = {}
+        display_screen(view, screen_scale=screen_scale, decode=decode, palette=palette, sinks=sinks, fps=fps, skip_frames=skip_frames, stats=stats)
+
+        if report:
+            report_frames(stats)
+
+        if listener is not None:
+            listener.stop()
 
-    keyboard.Listener(on_press=on_press, on_release=on_release).start()
+        for sink in sinks[1:]:
+            sink.close()
+        cv2.destroyAllWindows()
+    finally:
+        stop.set()
+        view.memory = None
+        memory.close()
+
+def run_with_render_process(cpu: CPU, run, screen: int, screen_scale: int = 1, io_address: int = None, sticky: bool = False, keys: dict[str, int] = None, sinks: list = None, fps: float = 60, skip_frames: bool = True, report: bool = False) -> None:
+    # moves the cpu's memory into shared memory, starts the render process on it and runs
+    # the cpu in this process with run(cpu) until either side stops
+    import multiprocessing
+    from multiprocessing import shared_memory
+
+    memory = shared_memory.SharedMemory(create=True, size=0x2000)
+    stop = multiprocessing.Event()
+
+    # same contents, so there's nothing to decode or translate again
+    memory.buf[:] = cpu.memory
+    cpu.memory = memory.buf
+
+    # the render process writes input straight into memory in the middle of batches,
+    # without touching generations, so a loop that looks idle might not be
+    skip_idle = cpu.skip_idle
+    cpu.skip_idle = False
+
+    process = multiprocessing.Process(target=render_screen, args=(memory.name, stop, screen, screen_scale, io_address, sticky, keys, sinks, fps, skip_frames, report), daemon=True)
+    process.start()
+    threading.Thread(target=stop_on_event, args=(stop,), daemon=True).start()
+
+    try:
+        run(cpu)
+    finally:
+        stop.set()
+        process.join()
+
+        # shared memory can't be closed while anything still points into it, so the cpu
+        # is left with a private copy
+        cpu.memory = bytearray(cpu.memory)
+        cpu.skip_idle = skip_idle
+        memory.close()
+        memory.unlink()
 
 def load_symbols(symbol_file: str | pathlib.Path) -> dict[str, int]:
     with open(symbol_file, 'r') as f:
@@ -620,37 +1430,129 @@ def load_symbols(symbol_file: str | pathlib.Path) -> dict[str, int]:
         return result["symbols"], lines
     return {}, {}
 
-def clock_cpu(cpu: CPU, accurate_clocks: bool = False, clock_speed: int = 1100) -> None:
+def profile_report(cpu: CPU, symbols: dict[str, int], lines: dict[int, tuple[int, str]], top: int = 20) -> dict:
+    # joins the cpu's profile with the program's symbols and source lines: the hottest
+    # source lines, how much ran under each label, every opcode, and how many times each
+    # loop (a taken backward branch) went round
+    profile = cpu.profile
+    total = sum(profile.pcs)
+
+    # code labels in address order, everything up to the next one is counted under it
+    labels = sorted((address, name) for name, address in symbols.items() if address in lines)
+    starts = [address for address, name in labels]
+
+    def routine(address: int) -> str:
+        i = bisect.bisect_right(starts, address)
+        return labels[i - 1][1] if i else f"${address:04X}"
+
+    hot_lines = []
+    routines = {}
+    for address, count in enumerate(profile.pcs):
+        if count == 0:
+            continue
+
+        number, source = lines.get(address, (None, f"${address:04X}"))
+        name = routine(address)
+        routines[name] = routines.get(name, 0) + count
+        hot_lines.append({"address": address, "line": number, "source": source, "routine": name, "count": count})
+
+    hot_lines.sort(key=lambda line: line["count"], reverse=True)
+
+    loops = []
+    for address, count in enumerate(profile.taken):
+        if count == 0:
+            continue
+
+        memory = cpu.memory
+        if memory[address] <= 0x23:
+            # 8-bit branches keep the page of the pc, which points at the operand
+            target = ((address + 1) & 0xFF00) | memory[address + 1]
+        else:
+            target = memory[address + 1] | (memory[address + 2] << 8)
+
+        if target <= address:
+            names = [name for start, name in labels if start == target]
+            loops.append({"branch": address, "target": target, "label": names[0] if names else None, "iterations": count})
+
+    loops.sort(key=lambda loop: loop["iterations"], reverse=True)
+
+    return {
+        "instructions": total,
+        "lines": hot_lines,
+        "top_lines": hot_lines[:top],
+        "routines": dict(sorted(routines.items(), key=lambda item: item[1], reverse=True)),
+        "opcodes": {cpu.instructions[opcode].__name__: count for opcode, count in enumerate(profile.opcodes) if count and opcode in cpu.instructions},
+        "loops": loops,
+    }
+
+def write_profile(report: dict, path: str | pathlib.Path) -> None:
+    # profile.json, and profile.folded with one routine;line stack per source line for
+    # flamegraph tools
+    path = pathlib.Path(path)
+
+    with open(path.joinpath("profile.json"), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    with open(path.joinpath("profile.folded"), 'w') as f:
+        for line in report["lines"]:
+            frame = f"{line['line']}: {line['source']}".replace(";", ",")
+            f.write(f"{line['routine']};{frame} {line['count']}\n")
+
+def clock_cpu(cpu: CPU, accurate_clocks: bool = False, clock_speed: int = 1100, slice_time: float = 0.002, max_lag: float = 0.05, report_interval: float = None) -> dict[str, float]:
+    # runs the cpu in slices of slice_time seconds of guest time, then sleeps until the
+    # slice's deadline. Deadlines are absolute, so sleep overshoot is made up by the
+    # following slices instead of drifting, but never by more than max_lag seconds (e.g.
+    # after the host stalls). Returns the target and achieved clock rates.
+    
     # Disable on Windows 
     if platform.system() == "Windows":
         accurate_clocks = False
 
+    stop_flag = lambda: not run_program
 
-    start = time.perf_counter_ns()
-    clock_speed = clock_speed
-
-    if accurate_clocks:
-        frame_time = 10**9 / clock_speed
-    else:
-        frame_time = 1 / clock_speed
-
-    skip_checks = False
+    start = time.perf_counter()
+    executed = 0
 
     if clock_speed == math.inf:
-        skip_checks = True
-
-    while run_program:
+        # nothing to time, so just run in batches off the fast path
+        executed, _ = cpu.run_until(stop_flag=stop_flag)
+    else:
+        slice_instructions = max(1, round(clock_speed * slice_time))
+        deadline = start
+        next_report = start + report_interval if report_interval else math.inf
         
-        cpu.clock()
-
-        if skip_checks: continue
-
-        if accurate_clocks:
-            while time.perf_counter_ns() < start:
-                pass
-            start += frame_time
-        else:
-            time.sleep(frame_time)
+        while run_program:
+            ran, _ = cpu.run(slice_instructions)
+            executed += ran
+            deadline += ran / clock_speed
+
+            now = time.perf_counter()
+
+            if now < deadline:
+                if accurate_clocks:
+                    # sleep through most of the wait, then spin for the last half millisecond
+                    if deadline - now > 0.0005:
+                        time.sleep(deadline - now - 0.0005)
+                    while time.perf_counter() < deadline:
+                        pass
+                else:
+                    time.sleep(deadline - now)
+            elif now - deadline > max_lag:
+                # too far behind to catch up, drop the missed time
+                deadline = now - max_lag
+
+            if now >= next_report:
+                print(f"Clock: {executed / (now - start):,.0f} Hz (target {clock_speed:,} Hz)")
+                next_report += report_interval
+
+    elapsed = time.perf_counter() - start
+
+    return {
+        "instructions": executed,
+        "seconds": elapsed,
+        "target_hz": clock_speed,
+        "achieved_hz": executed / elapsed if elapsed > 0 else 0.0,
+    }
 
 def parse_input(user_input: str):
     patterns = [
@@ -709,13 +1611,12 @@ def parse_number(num: str) -> int:
 def process_input(cpu: CPU, taps: list[tuple[str, int]], breaks: OrderedDict[int, str], symbols: dict[str, int], lines: dict[int, tuple[int, str]], args):
     match args[0]:
         case 0: # step to the next line of the program
-            cpu.clock()
+            cpu.run(1)
             print_taps(cpu, taps)
 
         case 1: # step next n lines of the program
             times = int(args[1])
-            for _ in range(times):
-                cpu.clock()
+            cpu.run(times)
             print_taps(cpu, taps)
 
         case 2: # run from beginning until a breakpoint
@@ -724,21 +1625,17 @@ def process_input(cpu: CPU, taps: list[tuple[str, int]], breaks: OrderedDict[int
                 action = input("This action will restart the program. Are you sure? (y/N): ").lower().strip() == "y"
                 cpu.pc = 0
 
-            while action:
-                cpu.clock()
-                if cpu.pc in breaks:
+            if action:
+                _, reason = cpu.run_until(pcs=breaks, stop_flag=lambda: not run_program)
+                if reason == "breakpoint":
                     print(f"Stopped at line {cpu.pc:04X}. Breakpoint: {breaks[cpu.pc]}")
-                    break
 
-            if action:
                 print_taps(cpu, taps)
 
         case 3: # continue until the next breakpoint
-            while True:
-                cpu.clock()
-                if cpu.pc in breaks:
-                    print(f"Stopped at line {cpu.pc:04X}. Breakpoint: {breaks[cpu.pc]}")
-                    break
+            _, reason = cpu.run_until(pcs=breaks, stop_flag=lambda: not run_program)
+            if reason == "breakpoint":
+                print(f"Stopped at line {cpu.pc:04X}. Breakpoint: {breaks[cpu.pc]}")
 
             print_taps(cpu, taps)
 
@@ -851,8 +1748,11 @@ def clock_cpu_debug(cpu: CPU) -> None:
     global run_program
     taps = []
     breaks = OrderedDict()
-    path = pathlib.Path(__file__).parent.joinpath('output')
-    symbols, lines = load_symbols(path / "symbols.dbg")
+    if cpu.symbols:
+        symbols, lines = cpu.symbols, cpu.lines
+    else:
+        path = pathlib.Path(__file__).parent.joinpath('output')
+        symbols, lines = load_symbols(path / "symbols.dbg")
 
     while run_program:
         user_input = input("(dbg) ")
@@ -865,42 +1765,106 @@ def clock_cpu_debug(cpu: CPU) -> None:
             run_program = False
             break
 
-def main(debug: bool = False, screen: int = 0, screen_scale: int = 1, sticky: bool = False, accurate_clocks: bool = False, clock_speed: int = 1100, io_address: int = None) -> None:
+def main(debug: bool = False, screen: int = 0, screen_scale: int = 1, sticky: bool = False, accurate_clocks: bool = False, clock_speed: int = 1100, io_address: int = None, translate: bool = False, recompile: bool = False, report_interval: float = None, headless: bool = False, sinks: list = None, capture_interval: int = 10000, frames: int = None, binary: bool = False, keys: dict[str, int] = None, render_process: bool = False, fps: float = 60, skip_frames: bool = True, record: str = None, replay: str = None, skip_idle: bool = True, profile: bool = False) -> None:
+    # the render process writes input straight into shared memory, past cpu.input, so
+    # there'd be nothing to record and the recording wouldn't replay to the same memory
+    if record is not None and render_process:
+        raise ValueError("Input can't be recorded with render_process")
+
     path = pathlib.Path(__file__).parent.joinpath('output')
-    cpu = CPU(rom=path.joinpath('rom.mif'), ram=path.joinpath('ram.mif'))
-    
-    if screen == 0:
+
+    image = path.joinpath('memory.bin') if binary else None
+    cpu = CPU(rom=path.joinpath('rom.mif'), ram=path.joinpath('ram.mif'), translate=translate, image=image, skip_idle=skip_idle, profile=profile)
+
+    if recompile:
+        recompiler.recompile(cpu, path)
+
+    if sinks is None:
+        sinks = []
+
+    if record is not None:
+        cpu.input.record()
+
+    if replay is not None:
+        replay_input(cpu, replay, sinks, screen, screen_scale=screen_scale, interval=capture_interval)
+    elif screen == 0:
         if debug:
             clock_cpu_debug(cpu)
         else:
-            clock_cpu(cpu, accurate_clocks, clock_speed)
+            clock_cpu(cpu, accurate_clocks, clock_speed, report_interval=report_interval)
+    elif headless:
+        capture_screen(cpu, sinks, screen, screen_scale=screen_scale, interval=capture_interval, frames=frames)
+    elif render_process:
+        if debug:
+            run = clock_cpu_debug
+        else:
+            run = lambda cpu: clock_cpu(cpu, accurate_clocks, clock_speed, report_interval=report_interval)
+
+        run_with_render_process(cpu, run, screen, screen_scale=screen_scale, io_address=io_address, sticky=sticky, keys=keys, sinks=sinks, fps=fps, skip_frames=skip_frames, report=report_interval is not None)
     else:
         if debug:
             clock_cpu_threaded = threading.Thread(target=clock_cpu_debug, args=(cpu,), daemon=True)
         else:
-            clock_cpu_threaded = threading.Thread(target=clock_cpu, args=(cpu, accurate_clocks, clock_speed), daemon=True)
+            clock_cpu_threaded = threading.Thread(target=clock_cpu, args=(cpu, accurate_clocks, clock_speed), kwargs={"report_interval": report_interval}, daemon=True)
+
+        # the window is just the first place frames go
+        sinks = [WindowSink(screen_scale)] + sinks
         
+        listener = None
         if io_address is not None:
-            register_keys(cpu, start=io_address+3, sticky=sticky)
+            listener = register_keys(cpu, start=io_address+3, sticky=sticky, keys=keys)
             register_mouse(cpu, start=io_address, screen_scale=screen_scale)
         
         clock_cpu_threaded.start()
         
+        stats = {}
         if screen == 1:
-            display_screen(cpu,screen_scale=screen_scale)
+            display_screen(cpu, screen_scale=screen_scale, sinks=sinks, fps=fps, skip_frames=skip_frames, stats=stats)
         elif screen == 2:
-            display_screen_2bit(cpu, screen_scale=screen_scale)
+            display_screen_2bit(cpu, screen_scale=screen_scale, sinks=sinks, fps=fps, skip_frames=skip_frames, stats=stats)
+
+        if report_interval is not None:
+            report_frames(stats)
+
+        if listener is not None:
+            listener.stop()
+
+        # the cpu thread finishes its batch once run_program is cleared, so the recording,
+        # memory hash and profile below all see it stopped. The debugger's thread is left
+        # alone, it's waiting for a command and only runs the cpu between them
+        if not debug:
+            clock_cpu_threaded.join()
+
+        for sink in sinks[1:]:
+            sink.close()
     
+        import cv2
         cv2.destroyAllWindows()
 
+    if record is not None:
+        save_recording(record, cpu.input.recording, cpu.executed)
+        digest = hashlib.sha256(bytes(cpu.memory)).hexdigest()
+        print(f"Recorded {len(cpu.input.recording)} input events over {cpu.executed:,} instructions, memory {digest[:16]}")
 
-if __name__ == "__main__":
-    buffer = np.zeros((32, 32, 3), dtype=np.uint8)
+    if profile:
+        if cpu.symbols:
+            symbols, lines = cpu.symbols, cpu.lines
+        else:
+            symbols, lines = load_symbols(path / "symbols.dbg")
+
+        report = profile_report(cpu, symbols, lines)
+        write_profile(report, path)
 
-    keys = {keyboard.Key.up: 0, 
-            keyboard.Key.left: 1, 
-            keyboard.Key.down: 2, 
-            keyboard.Key.right: 3}
+        print(f"Profiled {report['instructions']:,} instructions, hottest lines:")
+        for line in report["top_lines"][:10]:
+            print(f"{line['count']:>12,}  {line['routine']:<16} {line['line']}: {line['source']}")
+
+
+if __name__ == "__main__":
+    keys = {"up": 0, 
+            "left": 1, 
+            "down": 2, 
+            "right": 3}
 
     screen_scale = 15
 
@@ -909,21 +1873,36 @@ if __name__ == "__main__":
     sticky = True
     accurate_clocks = True
     clock_speed = math.inf
+    translate = True
+    recompile = True
+    binary = False
 
-    io_address = 0x1400
+    # show the screen and take input in a separate process, so the cpu has this one to itself
+    render_process = False
 
-    if screen != 0:
-        cv2.namedWindow(
-            'screen',
-            cv2.WINDOW_NORMAL    |
-            cv2.WINDOW_GUI_NORMAL
-        )
-        cv2.setWindowProperty(
-            'screen',
-            cv2.WND_PROP_ASPECT_RATIO,
-            cv2.WINDOW_KEEPRATIO
-        )
+    # save the input of this session to a file, or replay one without a window instead of
+    # running interactively (frames still go to sinks)
+    record = None # e.g. "session.rec"
+    replay = None
+
+    # count loops that only wait for input as run instead of running them
+    skip_idle = True
 
-        cv2.resizeWindow('screen', 32 * screen_scale, 32 * screen_scale)
+    # count every instruction run by address and opcode, and write output/profile.json and
+    # output/profile.folded at the end (slower)
+    profile = False
+
+    # frames per second the window is redrawn at (None for as often as possible), and whether
+    # to drop frames rather than fall behind
+    fps = 60
+    skip_frames = True
+
+    # run without a window, sending a frame to each sink every capture_interval instructions
+    headless = False
+    capture_interval = 10000
+    frames = None
+    sinks = [] # e.g. [PngSink("frames"), RawSink("frames.raw"), VideoSink("run.mp4", fps=30)]
+
+    io_address = 0x1400
 
-    main(debug=debug, screen=screen, screen_scale=screen_scale, sticky=sticky, accurate_clocks=accurate_clocks, clock_speed=clock_speed, io_address=io_address)
+    main(debug=debug, screen=screen, screen_scale=screen_scale, sticky=sticky, accurate_clocks=accurate_clocks, clock_speed=clock_speed, io_address=io_address, translate=translate, recompile=recompile, headless=headless, sinks=sinks, capture_interval=capture_interval, frames=frames, binary=binary, keys=keys, render_process=render_process, fps=fps, skip_frames=skip_frames, record=record, replay=replay, skip_idle=skip_idle, profile=profile)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Translates basic blocks of the predecoded ROM into Python functions, so a whole
+# straight-line run of instructions (ending in a branch) executes as one call.
+#
+# Every generated block has the signature
+#   block_XXXX(a, b, x, y, memory, generations) -> (next_pc, a, b, x, y)
+# and always runs the same number of instructions, which is cached next to it.
+
+MAX_BLOCK_LENGTH = 64
+
+# destination register, source registers, and expression for register-only instructions.
+# when all the sources are known constants the expression is folded at translation time
+REGISTER_OPS = {
+    0x00: ("b", "a", "{a}"),  # tab
+    0x01: ("a", "b", "{b}"),  # tba
+    0x14: ("a", "ab", "({a} + {b}) & 0xFF"),  # sum_ba
+    0x15: ("b", "ab", "({a} + {b}) & 0xFF"),  # sum_ab
+    0x16: ("a", "ab", "{a} & {b}"),  # and_ba
+    0x17: ("b", "ab", "{a} & {b}"),  # and_ab
+    0x18: ("a", "ab", "{a} | {b}"),  # or_ba
+    0x19: ("b", "ab", "{a} | {b}"),  # or_ab
+    0x1A: ("a", "a", "{a} ^ 0xFF"),  # coma
+    0x1B: ("b", "b", "{b} ^ 0xFF"),  # comb
+    0x1C: ("a", "a", "({a} << 1) & 0xFF"),  # shfa_l
+    0x1D: ("a", "a", "{a} >> 1"),  # shfa_r
+    0x1E: ("b", "b", "({b} << 1) & 0xFF"),  # shfb_l
+    0x1F: ("b", "b", "{b} >> 1"),  # shfb_r
+    0x30: ("x", "x", "({x} + 1) & 0xFFFF"),  # inx
+    0x31: ("y", "y", "({y} + 1) & 0xFFFF"),  # iny
+}
+
+IMMEDIATE_LOADS = {0x02: "a", 0x03: "b", 0x08: "x", 0x09: "y"}
+
+# beq, bne, bn, bp are told apart by the low two bits of the opcode
+BRANCH_CONDITIONS = ["{a} == 0", "{a} != 0", "{a} & 0x80", "not {a} & 0x80"]
+
+
+def find_block(decoded: list, pc: int) -> list[tuple[int, tuple[int, int, int]]]:
+    # walk the predecoded ROM from pc until a branch, something that has to go
+    # through the reference interpreter, or the end of ROM
+    block = []
+
+    while pc < 0x1000 and len(block) < MAX_BLOCK_LENGTH:
+        entry = decoded[pc]
+        if entry is None:
+            break
+
+        block.append((pc, entry))
+
+        opcode, operand, next_pc = entry
+        if 0x20 <= opcode <= 0x27:
+            break
+
+        pc = next_pc
+
+    return block
+
+
+def generate_block(decoded: list, pc: int, name: str = None) -> tuple[str, int, int] | None:
+    # returns the source of the function for the block at pc, how many instructions it
+    # runs and the address of its last instruction, or None if there's nothing at pc that
+    # can be translated
+    if name is None:
+        name = f"block_{pc:04X}"
+
+    known = {}  # registers holding a value known at translation time
+    body = []
+    count = 0
+    next_pc = pc
+    end = pc
+
+    def value(register: str) -> str:
+        if register in known:
+            return hex(known[register])
+        return register
+
+    def assign(register: str, sources: str, expression: str) -> None:
+        expression = expression.format(**{r: value(r) for r in "abxy"})
+        if all(source in known for source in sources):
+            known[register] = eval(expression)
+        else:
+            load(register, expression)
+
+    def load(register: str, expression: str) -> None:
+        known.pop(register, None)
+        body.append(f"{register} = {expression}")
+
+    for address, (opcode, operand, following) in find_block(decoded, pc):
+        end = address
+
+        if opcode in REGISTER_OPS:
+            assign(*REGISTER_OPS[opcode])
+
+        elif opcode in IMMEDIATE_LOADS:
+            known[IMMEDIATE_LOADS[opcode]] = operand
+
+        elif opcode in (0x04, 0x05):  # ldaa, ldab
+            load("ab"[opcode & 1], f"memory[{operand:#06x}]")
+
+        elif opcode in (0x06, 0x07):  # staa, stab
+            body.append(f"memory[{operand:#06x}] = {value('ab'[opcode & 1])}")
+            body.append(f"generations[{operand >> 8:#04x}] += 1")
+
+        elif opcode in (0x0A, 0x0B):  # ldx, ldy
+            load("xy"[opcode & 1], f"memory[{operand:#06x}] | (memory[{operand + 1:#06x}] << 8)")
+
+        elif 0x0C <= opcode <= 0x13:  # indexed loads and stores
+            index = "xy"[opcode & 1]
+            register = "a" if opcode in (0x0C, 0x0D, 0x10, 0x11) else "b"
+
+            if index in known:
+                target = (known[index] + operand) & 0xFFFF
+                if target >= 0x2000 or opcode >= 0x10 and target < 0x1000:
+                    # faults, so leave it for the interpreter to report
+                    end = next_pc - 1
+                    break
+
+                if opcode < 0x10:
+                    load(register, f"memory[{target:#06x}]")
+                else:
+                    body.append(f"memory[{target:#06x}] = {value(register)}")
+                    body.append(f"generations[{target >> 8:#04x}] += 1")
+            else:
+                target = index if operand == 0 else f"({index} + {operand}) & 0xFFFF"
+
+                if opcode < 0x10:
+                    load(register, f"memory[{target}]")
+                else:
+                    body.append(f"t = {target}")
+                    body.append("if t < 0x1000: raise ValueError('Cannot write to ROM')")
+                    body.append(f"memory[t] = {value(register)}")
+                    body.append("generations[t >> 8] += 1")
+
+        elif 0x20 <= opcode <= 0x27:
+            condition = BRANCH_CONDITIONS[opcode & 3].format(a=value("a"))
+            count += 1
+
+            if "a" in known:
+                next_pc = operand if eval(condition) else following
+            else:
+                next_pc = f"({operand:#06x} if {condition} else {following:#06x})"
+            break
+
+        count += 1
+        next_pc = following
+
+    if count == 0:
+        return None
+
+    if isinstance(next_pc, int):
+        next_pc = f"{next_pc:#06x}"
+
+    registers = ", ".join(value(r) for r in "abxy")
+    body.append(f"return {next_pc}, {registers}")
+
+    source = f"def {name}(a, b, x, y, memory, generations):\n" + "".join(f"    {line}\n" for line in body)
+    return source, count, end
+
+
+def compile_block(source: str, name: str, filename: str = "<translated>"):
+    namespace = {}
+    exec(compile(source, filename, "exec"), namespace)
+    return namespace[name]
+
+
+class BlockCache:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.blocks = {}  # start pc -> (function, instruction count, address of last instruction)
+
+    def clear(self) -> None:
+        self.blocks.clear()
+
+    def translate(self, pc: int) -> tuple:
+        generated = None
+        if pc < 0x1000:
+            name = f"block_{pc:04X}"
+            generated = generate_block(self.cpu.decoded, pc, name)
+
+        if generated is None:
+            # remember that there's nothing to translate here
+            block = (None, 0, pc)
+        else:
+            source, count, end = generated
+            block = (compile_block(source, name, f"<block ${pc:04X}>"), count, end)
+
+        self.blocks[pc] = block
+        return block
+
+    def execute(self, count: int, stops: frozenset[int] = None) -> int:
+        # runs up to count instructions a block at a time, stopping early if the pc lands
+        # on one of stops. Blocks that don't fit in what's left of count or that have a stop
+        # inside them, and anything that can't be translated, go through the interpreter.
+        # If a block raises, the registers are left as they were at the start of the block
+        cpu = self.cpu
+        blocks = self.blocks
+        memory = cpu.memory
+        generations = cpu.generations
+        a, b, x, y, pc = cpu.a, cpu.b, cpu.x, cpu.y, cpu.pc
+        executed = 0
+
+        try:
+            while executed < count:
+                block = blocks.get(pc)
+                if block is None:
+                    block = self.translate(pc)
+
+                function, size, end = block
+
+                if stops:
+                    if executed and pc in stops:
+                        break
+                    if any(pc < stop <= end for stop in stops):
+                        function = None
+
+                if function is None or executed + size > count:
+                    cpu.a, cpu.b, cpu.x, cpu.y, cpu.pc = a, b, x, y, pc
+                    executed += cpu.interpret(1)
+                    a, b, x, y, pc = cpu.a, cpu.b, cpu.x, cpu.y, cpu.pc
+                    continue
+
+                pc, a, b, x, y = function(a, b, x, y, memory, generations)
+                executed += size
+        except IndexError:
+            raise ValueError("Memory address is out of bounds") from None
+        finally:
+            cpu.a, cpu.b, cpu.x, cpu.y, cpu.pc = a, b, x, y, pc
+
+        return executed